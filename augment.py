@@ -23,6 +23,26 @@ parser.add_argument('--input_file', required=True, type=str, help='原始数据
 parser.add_argument('--output', required=True, type=str, help='增强数据的输出路径')
 parser.add_argument('--num_aug', required=False, type=int, default=9, help='每条原始语句增强的语句数')
 parser.add_argument('--alpha', required=False, type=float, default=0.1, help='每条语句中将会被改变的单词数占比')
+parser.add_argument('--bt_config', required=False, type=str, default='bt/config.json',
+                    help='百度翻译配置文件，包含接口地址和appid密钥池，由bt/config.example.json复制后填写')
+parser.add_argument('--bt_host', required=False, type=str, default=None,
+                    help='回译接口地址，默认读取配置文件，可指向本地bt/stub_server.py，如127.0.0.1:8000')
+parser.add_argument('--bt_qps', required=False, type=float, default=None, help='每个appid的QPS上限，默认读取配置文件')
+parser.add_argument('--bt_threads', required=False, type=int, default=None, help='回译请求的并发线程数，默认为appid数的两倍')
+parser.add_argument('--bt_backend', required=False, type=str, default='baidu',
+                    help='回译后端：baidu(百度翻译API)或phrase_table(本地短语表，离线)')
+parser.add_argument('--bt_table_dir', required=False, type=str, default='data/phrase_tables/',
+                    help='本地短语表目录，每种语言需同时包含zh-<lan>.txt和<lan>-zh.txt，仓库中不附带，需自行准备')
+parser.add_argument('--bt_workers', required=False, type=int, default=None, help='本地回译的进程数，默认为CPU核数')
+parser.add_argument('--bt_min_novelty', required=False, type=float, default=0.05,
+                    help='中间语言产生新回译句的比例低于该值时不再使用')
+parser.add_argument('--bt_pivot_stats', required=False, type=str, default=None,
+                    help='中间语言产出统计的存储文件，跨多次运行累积')
+parser.add_argument('--bt_cache', required=False, type=str, default=None,
+                    help='翻译缓存文件，跨多次运行复用已翻译的文本')
+parser.add_argument('--dry_run', '--dry-run', action='store_true',
+                    help='只统计数据并估算回译的请求数、计费字符数和耗时，不实际增强')
+parser.add_argument('--bt_batch_size', required=False, type=int, default=64, help='每批回译的语句数')
 args = parser.parse_args()
 
 
@@ -30,7 +50,8 @@ file_name = args.method + '_' + os.path.basename(args.input_file)
 output_file = os.path.join(args.output, file_name)
 
 
-def augment(method, original_data, o_file, n_aug, p_change):
+def augment(method, original_data, o_file, n_aug, p_change, bt_backend=None, bt_batch_size=64, bt_planner=None,
+            bt_cache=None):
     print("正在使用{}生成增强语句...".format(method))
     if method == 'cvae':
         with open(original_data, 'r', encoding='utf-8') as input_f:
@@ -48,26 +69,83 @@ def augment(method, original_data, o_file, n_aug, p_change):
         result = []
         with open(original_data, 'r') as file:
             reader = csv.reader(file)
-            for item in reader:
-                if reader.line_num == 1:
-                    continue
-                label = item[0]
-                sentence = item[1]
-                if method == 'eda':
-                    aug_sentences = eda_gen.eda(sentence, p_change, p_change, p_change, p_change, n_aug)
-                elif method == 'bt':
-                    aug_sentences = bt_gen.back_translate(sentence)
+            rows = [item for item in reader if reader.line_num != 1]
+        if method == 'eda':
+            for item in rows:
+                aug_sentences = eda_gen.eda(item[1], p_change, p_change, p_change, p_change, n_aug)
                 for aug_sentence in aug_sentences:
-                    result.append([label, aug_sentence])
+                    result.append([item[0], aug_sentence])
+        elif method == 'bt':
+            bt_planner = bt_planner or bt_gen.PivotPlanner()
+            if bt_cache is None:
+                bt_cache = bt_gen.TranslationCache()
+            done = 0
+            try:
+                for start in range(0, len(rows), bt_batch_size):
+                    batch = rows[start:start + bt_batch_size]
+                    batch_aug = bt_gen.back_translate_batch([item[1] for item in batch], bt_backend, n_aug,
+                                                         bt_planner, bt_cache)
+                    for item, aug_sentences in zip(batch, batch_aug):
+                        for aug_sentence in aug_sentences:
+                            result.append([item[0], aug_sentence])
+                    done += len(batch)
+            except bt_gen.TranslateError as e:
+                # 所有密钥都已停用，不再请求；已完成的语句、缓存和中间语言统计照常保存
+                print('回译中止（{}），已完成{}/{}条原始语句'.format(e, done, len(rows)))
         random.shuffle(result)
         result = [['label', 'text']] + result
         with open(o_file, 'w') as csvfile:
             writer = csv.writer(csvfile)
             for item in result:
                 writer.writerow(item)
+        if method == 'bt':
+            bt_gen.report_errors()
+            if bt_backend is not None:
+                bt_backend.report()
+            bt_planner.report()
+            bt_planner.save()
+            bt_cache.report()
+            bt_cache.save()
     print("已生成增强语句!")
     print('存储路径：', o_file)
 
 
+def dry_run(method, original_data, n_aug, bt_planner=None, bt_cache=None, bt_qps=None):
+    with open(original_data, 'r') as file:
+        reader = csv.reader(file)
+        sentences = [item[1] for item in reader if reader.line_num != 1]
+    print('原始语句数：{}，去重后：{}'.format(len(sentences), len(set(sentences))))
+    if method != 'bt':
+        return
+    if bt_cache is not None:
+        print('缓存中已有译文：{}'.format(len(bt_cache)))
+    for early_stop in (True, False):
+        est = bt_gen.estimate_back_translate(sentences, n_aug, bt_planner, bt_cache, early_stop)
+        print('{}：'.format('按中间语言产出率提前停止（预计）' if early_stop else '使用全部可用中间语言（上限）'))
+        print('  正向请求 {}（缓存命中 {}），反向请求 {}（缓存命中 {}）'.format(
+            est['forward_calls'], est['forward_hits'], est['backward_calls'], est['backward_hits']))
+        print('  请求总数 {}，计费字符数约 {}'.format(est['calls'], est['chars']))
+        if bt_qps:
+            seconds = est['calls'] / bt_qps
+            print('  总QPS {:.2f}，预计耗时 {:.0f}s（{:.2f}h）'.format(bt_qps, seconds, seconds / 3600))
+
+
 if __name__ == '__main__':
-    augment(args.method, args.input_file, output_file, args.num_aug, args.alpha)
+    backend, planner, cache = None, None, None
+    if args.method == 'bt':
+        planner = bt_gen.PivotPlanner(min_rate=args.bt_min_novelty, stats_file=args.bt_pivot_stats)
+        cache = bt_gen.TranslationCache(args.bt_cache)
+        if args.bt_backend == 'phrase_table':
+            backend = bt_gen.PhraseTableBackend(args.bt_table_dir, workers=args.bt_workers)
+        else:
+            config = bt_gen.load_config(args.bt_config)
+            backend = bt_gen.BaiduBackend(pool=bt_gen.KeyPool.from_config(config, args.bt_qps),
+                                          host=args.bt_host or config['host'], threads=args.bt_threads)
+    if args.dry_run:
+        qps = backend.pool.qps if isinstance(backend, bt_gen.BaiduBackend) else None
+        dry_run(args.method, args.input_file, args.num_aug, planner, cache, qps)
+    else:
+        augment(args.method, args.input_file, output_file, args.num_aug, args.alpha, backend, args.bt_batch_size,
+                planner, cache)
+    if backend is not None:
+        backend.close()
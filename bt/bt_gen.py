@@ -11,47 +11,622 @@
 
 import http.client
 import hashlib
+import os
+import multiprocessing
 import urllib
 import random
 import json
 import time
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
 
+# 百度翻译API错误码分类
+# 52001 请求超时、52002 系统错误：可重试
+RETRY_CODES = {'52001', '52002'}
+# 54003 访问频率受限、54005 长query请求频繁：降速后重试
+RATE_LIMIT_CODES = {'54003', '54005'}
+# 54000 必填参数为空、58001 译文语言方向不支持：与当前query有关，重试无意义
+PERMANENT_CODES = {'54000', '58001'}
+# 52003 未授权用户、54001 签名错误、54004 账户余额不足、58000 客户端IP非法、58002 服务已关闭、90107 认证未通过：
+# 账户级错误，后续请求都会失败，直接终止
+FATAL_CODES = {'52003', '54001', '54004', '58000', '58002', '90107'}
 
-def baidu_translate(client, ori_query, toLang='zh', fromLang='auto'):
-    appid = '20200805000533734'
-    secretKey = 'Rs9KEdIEoaAEZhUim0tA'
-    time.sleep(1)
-    salt = random.randint(32768, 65536)
-    sign = appid + ori_query + str(salt) + secretKey
-    sign = hashlib.md5(sign.encode()).hexdigest()
-    myurl = '/api/trans/vip/translate'
-    myurl += '?appid=' + appid + '&q=' + urllib.parse.quote(
-        ori_query) + '&from=' + fromLang + '&to=' + toLang + '&salt=' + str(
-        salt) + '&sign=' + sign
-    new_query = []
-    try:
-        client.request('GET', myurl)
-        response = client.getresponse()
-        result_all = response.read().decode("utf-8")
-        result = json.loads(result_all)
-        for each in result['trans_result']:
-            new_query.append(each['dst'])
-    except Exception as e:
-        print(e)
-    return new_query
-
-
-def back_translate(query):
-    httpClient = http.client.HTTPConnection('api.fanyi.baidu.com')
-    aug_query = [query]
-    lan_list = "en,jp,kor,fra,spa,th,ara,ru,de".split(",")
-    for tmp_lan in lan_list:
-        for tmp_q in baidu_translate(httpClient, query, tmp_lan):
-            aug_query.extend(baidu_translate(httpClient, tmp_q, 'zh'))
-    httpClient.close()
-    return aug_query
+MAX_RETRIES = 5
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 32.0
+# 默认的百度翻译配置：接口地址和密钥池；该文件含密钥，不纳入版本库，由config.example.json复制后填写
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')
+
+LAN_LIST = "en,jp,kor,fra,spa,th,ara,ru,de".split(",")
+
+# 按错误码统计本次运行中出现的错误次数；BaiduBackend的多个线程同时写入，经count_error加锁更新
+error_stats = collections.Counter()
+_error_lock = threading.Lock()
+
+
+class TranslateError(Exception):
+    def __init__(self, code, msg=''):
+        super(TranslateError, self).__init__('{}: {}'.format(code, msg))
+        self.code = code
+        self.msg = msg
+
+
+class RateLimiter(object):
+    """
+    按QPS限速，遇到限流错误时乘性降速，每次成功后按上限的recover_step比例加性恢复
+    """
+    def __init__(self, qps=1.0, min_qps=0.1, recover_step=0.05):
+        self.max_qps = qps
+        self.min_qps = min(min_qps, qps)
+        self.qps = qps
+        self.recover_step = recover_step
+        self._next_time = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def next_time(self):
+        return self._next_time
+
+    def reserve(self):
+        """
+        预占下一个请求时间片，返回需要等待的秒数
+        """
+        with self._lock:
+            now = time.time()
+            wait_time = self._next_time - now
+            self._next_time = max(now, self._next_time) + 1.0 / self.qps
+        return wait_time
+
+    def wait(self):
+        wait_time = self.reserve()
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+    def backoff(self):
+        with self._lock:
+            self.qps = max(self.min_qps, self.qps / 2)
+
+    def success(self):
+        with self._lock:
+            self.qps = min(self.max_qps, self.qps + self.recover_step * self.max_qps)
+
+
+class Credential(object):
+    """
+    一个appid及其独立的限速器和状态：alive为False表示账户级错误（鉴权失败、余额不足等）已被停用
+    """
+    def __init__(self, appid, secret_key, qps=1.0):
+        self.appid = appid
+        self.secret_key = secret_key
+        self.limiter = RateLimiter(qps=qps)
+        self.alive = True
+        self.requests = 0
+        self.errors = collections.Counter()
+
+
+class KeyPool(object):
+    """
+    多个appid组成的密钥池，每次请求调度到最早有空闲配额的可用密钥上，N个密钥的吞吐约为单个的N倍
+    """
+    def __init__(self, credentials):
+        if not credentials:
+            raise ValueError('key pool is empty')
+        self.credentials = credentials
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config, qps=None):
+        return cls([Credential(key['appid'], key['secret_key'], qps or key.get('qps', 1.0))
+                    for key in config['keys']])
+
+    def __len__(self):
+        return len(self.credentials)
+
+    @property
+    def qps(self):
+        return sum(cred.limiter.max_qps for cred in self.credentials if cred.alive)
+
+    def acquire(self):
+        with self._lock:
+            alive = [cred for cred in self.credentials if cred.alive]
+            if not alive:
+                raise TranslateError('no_key', 'all keys are disabled')
+            cred = min(alive, key=lambda c: c.limiter.next_time)
+            wait_time = cred.limiter.reserve()
+            cred.requests += 1
+        if wait_time > 0:
+            time.sleep(wait_time)
+        return cred
+
+    def disable(self, cred, code, msg=''):
+        with self._lock:
+            if cred.alive:
+                cred.alive = False
+                print('停用appid {} ({}: {})'.format(cred.appid, code, msg))
+
+    def report(self):
+        print('密钥池状态：')
+        for cred in self.credentials:
+            print('  {}\t{}\tqps={:.2f}\trequests={}\terrors={}'.format(
+                cred.appid, 'alive' if cred.alive else 'disabled', cred.limiter.qps,
+                cred.requests, dict(cred.errors)))
+
+
+def count_error(code, cred=None):
+    """
+    Counter的+=不是原子操作，全局和单个密钥的错误计数都在锁内更新
+    """
+    with _error_lock:
+        error_stats[code] += 1
+        if cred is not None:
+            cred.errors[code] += 1
+
+
+def load_config(config_file=DEFAULT_CONFIG):
+    if not os.path.exists(config_file):
+        raise FileNotFoundError('baidu translate config {} not found, copy bt/config.example.json to it and fill in '
+                                'your appid and secret_key'.format(config_file))
+    with open(config_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def backoff_delay(attempt):
+    # full jitter：在[0, min(max, base*2^attempt)]内随机等待，避免多个请求同时重试
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def classify_error(code):
+    code = str(code)
+    if code in RATE_LIMIT_CODES:
+        return 'rate_limit'
+    if code in RETRY_CODES:
+        return 'retry'
+    if code in FATAL_CODES:
+        return 'fatal'
+    if code in PERMANENT_CODES:
+        return 'permanent'
+    return 'retry'
+
+
+def report_errors():
+    if not error_stats:
+        print('翻译接口无错误')
+        return
+    print('翻译接口错误统计：')
+    for code, count in sorted(error_stats.items()):
+        kind = classify_error(code) if code.isdigit() else '-'
+        print('  {}\t{}\t{}'.format(code, kind, count))
+
+
+class TranslationBackend(object):
+    """
+    翻译后端接口：translate(query, toLang, fromLang) 返回译文列表，失败时返回空列表
+    """
+    name = 'base'
+
+    def translate(self, query, toLang='zh', fromLang='auto'):
+        raise NotImplementedError
+
+    def translate_batch(self, queries, toLang='zh', fromLang='auto'):
+        return [self.translate(query, toLang, fromLang) for query in queries]
+
+    def close(self):
+        pass
+
+    def report(self):
+        pass
+
+
+class BaiduBackend(TranslationBackend):
+    """
+    百度翻译通用API，密钥池和host从配置文件读取，host可指向本地的stub_server做离线压测；
+    批量翻译时用线程池并发请求，并发数默认为密钥数的两倍
+    """
+    name = 'baidu'
+    url = '/api/trans/vip/translate'
+
+    def __init__(self, pool=None, host=None, threads=None, max_retries=MAX_RETRIES, timeout=10,
+                 config_file=DEFAULT_CONFIG):
+        if pool is None or host is None:
+            config = load_config(config_file)
+            pool = pool or KeyPool.from_config(config)
+            host = host or config['host']
+        self.pool = pool
+        self.host = host
+        self.threads = threads or 2 * len(pool)
+        self.max_retries = max_retries
+        self.timeout = timeout
+        # 每个线程持有自己的长连接
+        self._local = threading.local()
+        self._clients = []
+        self._executor = None
+
+    def _client(self):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = http.client.HTTPConnection(self.host, timeout=self.timeout)
+            self._local.client = client
+            self._clients.append(client)
+        return client
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        for client in self._clients:
+            client.close()
+        self._clients = []
+        self._local = threading.local()
+
+    def report(self):
+        self.pool.report()
+
+    def _request(self, cred, query, toLang, fromLang):
+        salt = random.randint(32768, 65536)
+        sign = cred.appid + query + str(salt) + cred.secret_key
+        sign = hashlib.md5(sign.encode()).hexdigest()
+        myurl = self.url
+        myurl += '?appid=' + cred.appid + '&q=' + urllib.parse.quote(
+            query) + '&from=' + fromLang + '&to=' + toLang + '&salt=' + str(
+            salt) + '&sign=' + sign
+        client = self._client()
+        try:
+            client.request('GET', myurl)
+            response = client.getresponse()
+            return json.loads(response.read().decode("utf-8"))
+        except (http.client.HTTPException, OSError, ValueError):
+            # 关闭出错的连接，下次请求会自动重连
+            client.close()
+            raise
+
+    def translate(self, query, toLang='zh', fromLang='auto'):
+        attempt = 0
+        while attempt <= self.max_retries:
+            cred = self.pool.acquire()
+            try:
+                result = self._request(cred, query, toLang, fromLang)
+            except (http.client.HTTPException, OSError, ValueError) as e:
+                code, kind, msg = 'network', 'retry', str(e)
+            else:
+                code = str(result.get('error_code', '52000'))
+                if code == '52000':
+                    cred.limiter.success()
+                    return [each['dst'] for each in result['trans_result']]
+                kind, msg = classify_error(code), result.get('error_msg', '')
+            count_error(code, cred)
+            if kind == 'fatal':
+                # 账户级错误只停用当前密钥，换下一个可用密钥重试，不计入重试次数
+                self.pool.disable(cred, code, msg)
+                continue
+            if kind == 'permanent':
+                print('翻译失败（不重试） {}: {} [{}]'.format(code, msg, query))
+                return []
+            if kind == 'rate_limit':
+                cred.limiter.backoff()
+            if attempt < self.max_retries:
+                time.sleep(backoff_delay(attempt))
+            attempt += 1
+        print('翻译失败（重试{}次） {}: {} [{}]'.format(self.max_retries, code, msg, query))
+        count_error('gave_up')
+        return []
+
+    def translate_batch(self, queries, toLang='zh', fromLang='auto'):
+        if self.threads <= 1 or len(queries) <= 1:
+            return [self.translate(query, toLang, fromLang) for query in queries]
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.threads)
+        return list(self._executor.map(lambda query: self.translate(query, toLang, fromLang), queries))
+
+
+########################################################################
+# 本地短语表翻译
+# 以中文为枢纽，每个语言方向一个短语表，贪心最长匹配逐段替换，不依赖网络和配额
+########################################################################
+_phrase_tables = {}
+
+
+def load_phrase_table(path):
+    """
+    每行"源短语\t目标短语"，同一源短语取第一次出现的译文
+    --return: (dict, 源短语的最大长度)，中文按字计长度，其他语言按空格分词计长度
+    """
+    zh_source = os.path.basename(path).startswith('zh-')
+    table, max_len = {}, 1
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            items = line.rstrip('\n').split('\t')
+            if len(items) != 2 or not items[0].strip():
+                continue
+            src = items[0].strip() if zh_source else ' '.join(items[0].split())
+            if src not in table:
+                table[src] = items[1].strip()
+                max_len = max(max_len, len(src) if zh_source else len(src.split()))
+    return table, max_len
+
+
+def _init_phrase_tables(tables):
+    global _phrase_tables
+    _phrase_tables = tables
+
+
+def translate_with_table(query, direction, table, max_len):
+    """
+    贪心最长匹配逐段替换；只要有片段不在短语表中就不返回译文，避免未翻译的原文混入结果（如"请帮我查询flightinfo"）
+    """
+    zh_source = direction.startswith('zh-')
+    units = [c for c in query if not c.isspace()] if zh_source else query.split()
+    sep = '' if zh_source else ' '
+    result, i = [], 0
+    while i < len(units):
+        for n in range(min(max_len, len(units) - i), 0, -1):
+            phrase = sep.join(units[i:i + n])
+            if phrase in table:
+                result.append(table[phrase])
+                i += n
+                break
+        else:
+            return []
+    if not result:
+        return []
+    return [('' if direction.endswith('-zh') else ' ').join(result)]
+
+
+def _pool_translate(task):
+    query, direction = task
+    if direction not in _phrase_tables:
+        return []
+    table, max_len = _phrase_tables[direction]
+    return translate_with_table(query, direction, table, max_len)
+
+
+class PhraseTableBackend(TranslationBackend):
+    """
+    离线翻译后端：从table_dir读取zh-<lan>.txt和<lan>-zh.txt短语表，只使用两个方向都有表的语言
+    （由正向表反转得到的反向表只会把译文翻回原句，不产生新句）；批量翻译时用进程池并行，吞吐量只受CPU核数限制
+    """
+    name = 'phrase_table'
+
+    def __init__(self, table_dir, workers=None, chunk_size=64):
+        self.tables = {}
+        for lan in LAN_LIST:
+            forward = os.path.join(table_dir, 'zh-{}.txt'.format(lan))
+            backward = os.path.join(table_dir, '{}-zh.txt'.format(lan))
+            if os.path.isfile(forward) and os.path.isfile(backward):
+                self.tables['zh-' + lan] = load_phrase_table(forward)
+                self.tables[lan + '-zh'] = load_phrase_table(backward)
+            elif os.path.isfile(forward) or os.path.isfile(backward):
+                print('跳过{}：需要同时提供{}和{}'.format(lan, os.path.basename(forward), os.path.basename(backward)))
+        if not self.tables:
+            raise ValueError('no pair of zh-<lan>.txt and <lan>-zh.txt phrase tables found in {}, '
+                             'phrase tables are not shipped and must be supplied'.format(table_dir))
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self._pool = None
+
+    @staticmethod
+    def direction(toLang, fromLang):
+        # 只支持以中文为一端的方向，反向翻译需要给出源语言
+        return 'zh-' + toLang if toLang != 'zh' else fromLang + '-zh'
+
+    def translate(self, query, toLang='zh', fromLang='auto'):
+        direction = self.direction(toLang, fromLang)
+        if direction not in self.tables:
+            return []
+        table, max_len = self.tables[direction]
+        return translate_with_table(query, direction, table, max_len)
+
+    def translate_batch(self, queries, toLang='zh', fromLang='auto'):
+        direction = self.direction(toLang, fromLang)
+        if direction not in self.tables:
+            return [[] for _ in queries]
+        if self.workers <= 1 or len(queries) <= self.chunk_size:
+            return [self.translate(query, toLang, fromLang) for query in queries]
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.workers, initializer=_init_phrase_tables,
+                                              initargs=(self.tables,))
+        tasks = [(query, direction) for query in queries]
+        return self._pool.map(_pool_translate, tasks, chunksize=self.chunk_size)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
+########################################################################
+# 中间语言规划
+# 统计每种中间语言产生新回译句的比例，优先使用产出高的语言，跳过几乎不产出新句的语言
+########################################################################
+class PivotPlanner(object):
+    """
+    novelty rate = 产生了新回译句（与原句及已有回译句都不同）的语句数 / 经过该语言回译的语句数，
+    用(novel+1)/(attempts+2)平滑；尝试次数达到min_trials且平滑后低于min_rate的语言不再使用
+    """
+    def __init__(self, lan_list=LAN_LIST, min_rate=0.05, min_trials=20, stats_file=None):
+        self.lan_list = list(lan_list)
+        self.min_rate = min_rate
+        self.min_trials = min_trials
+        self.stats_file = stats_file
+        self.stats = {lan: {'attempts': 0, 'novel': 0} for lan in self.lan_list}
+        if stats_file and os.path.isfile(stats_file):
+            with open(stats_file, 'r', encoding='utf-8') as f:
+                for lan, item in json.load(f).items():
+                    if lan in self.stats:
+                        self.stats[lan] = item
+
+    def rate(self, lan):
+        item = self.stats[lan]
+        return (item['novel'] + 1.0) / (item['attempts'] + 2.0)
+
+    def usable(self, lan):
+        return self.stats[lan]['attempts'] < self.min_trials or self.rate(lan) >= self.min_rate
+
+    def next_pivot(self, tried):
+        candidates = [lan for lan in self.lan_list if lan not in tried and self.usable(lan)]
+        if not candidates:
+            return None
+        return max(candidates, key=self.rate)
+
+    def update(self, lan, attempts, novel):
+        self.stats[lan]['attempts'] += attempts
+        self.stats[lan]['novel'] += novel
+
+    def save(self):
+        if self.stats_file:
+            with open(self.stats_file, 'w', encoding='utf-8') as f:
+                json.dump(self.stats, f, indent=2)
+
+    def report(self):
+        print('中间语言产出统计：')
+        for lan in sorted(self.lan_list, key=self.rate, reverse=True):
+            item = self.stats[lan]
+            print('  {}\tattempts={}\tnovel={}\trate={:.3f}{}'.format(
+                lan, item['attempts'], item['novel'], self.rate(lan), '' if self.usable(lan) else '\t(skipped)'))
+
+
+########################################################################
+# 翻译缓存
+# 按目标语言缓存译文，批量翻译前先去重、查缓存，只请求未命中的文本
+########################################################################
+class TranslationCache(object):
+    """
+    按目标语言分表缓存译文，key为(源语言, 原文)；翻译失败的空结果不缓存，下次仍会重新请求。
+    指定cache_file时从文件载入，save()写回，跨多次运行复用
+    """
+    def __init__(self, cache_file=None):
+        self.cache_file = cache_file
+        self.tables = collections.defaultdict(dict)
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+        self._lock = threading.Lock()
+        if cache_file and os.path.isfile(cache_file):
+            with open(cache_file, 'r', encoding='utf-8') as f:
+                for toLang, table in json.load(f).items():
+                    self.tables[toLang] = {tuple(key.split('\t', 1)): value for key, value in table.items()}
+
+    def __len__(self):
+        return sum(len(table) for table in self.tables.values())
+
+    def get(self, query, toLang, fromLang='auto'):
+        return self.tables[toLang].get((fromLang, query))
+
+    def put(self, query, result, toLang, fromLang='auto'):
+        if result:
+            with self._lock:
+                self.tables[toLang][(fromLang, query)] = result
+
+    def translate_batch(self, backend, queries, toLang='zh', fromLang='auto'):
+        """
+        先对queries去重，命中缓存的直接返回，其余去重后的文本一次批量交给backend翻译
+        """
+        unique = list(dict.fromkeys(queries))
+        todo = [query for query in unique if self.get(query, toLang, fromLang) is None]
+        self.hits[toLang] += len(queries) - len(todo)
+        self.misses[toLang] += len(todo)
+        results = {query: self.get(query, toLang, fromLang) for query in unique}
+        for query, result in zip(todo, backend.translate_batch(todo, toLang, fromLang) if todo else []):
+            self.put(query, result, toLang, fromLang)
+            results[query] = result
+        return [results[query] for query in queries]
+
+    def save(self):
+        if self.cache_file:
+            with open(self.cache_file, 'w', encoding='utf-8') as f:
+                json.dump({toLang: {'\t'.join(key): value for key, value in table.items()}
+                           for toLang, table in self.tables.items()}, f, ensure_ascii=False)
+
+    def report(self):
+        print('翻译缓存统计：')
+        for toLang in sorted(set(self.hits) | set(self.misses)):
+            print('  {}\thits={}\tmisses={}'.format(toLang, self.hits[toLang], self.misses[toLang]))
+
+
+def back_translate_batch(queries, backend=None, num_aug=None, planner=None, cache=None):
+    """
+    对一批语句做回译：按planner给出的顺序逐个中间语言批量正向翻译，再把中间结果批量译回中文；
+    正反两个方向都先去重再查缓存，重复的语句和相同的中间译文只请求一次；
+    每条语句只保留与原句不同且互不重复的回译句，凑够num_aug条后不再参与后续语言的翻译
+    --return: 与queries等长的列表，每项为[原句, 回译句...]
+    """
+    own_backend = backend is None
+    if own_backend:
+        backend = BaiduBackend()
+    planner = planner or PivotPlanner(min_rate=0.0)
+    if cache is None:
+        cache = TranslationCache()
+    aug_queries = [[query] for query in queries]
+    seen = [{query} for query in queries]
+    tried = set()
+    while True:
+        active = [i for i in range(len(queries)) if num_aug is None or len(aug_queries[i]) - 1 < num_aug]
+        tmp_lan = planner.next_pivot(tried)
+        if not active or tmp_lan is None:
+            break
+        tried.add(tmp_lan)
+        index, tmp_queries = [], []
+        forward = cache.translate_batch(backend, [queries[i] for i in active], tmp_lan)
+        for i, tmp_qs in zip(active, forward):
+            for tmp_q in tmp_qs:
+                index.append(i)
+                tmp_queries.append(tmp_q)
+        # 只有正反两个方向都拿到译文的语句才计入该语言的尝试数，请求失败不拉低产出率
+        answered, novel = set(), set()
+        for i, back_qs in zip(index, cache.translate_batch(backend, tmp_queries, 'zh', tmp_lan)):
+            if back_qs:
+                answered.add(i)
+            for back_q in back_qs:
+                if back_q not in seen[i] and (num_aug is None or len(aug_queries[i]) - 1 < num_aug):
+                    seen[i].add(back_q)
+                    aug_queries[i].append(back_q)
+                    novel.add(i)
+        planner.update(tmp_lan, len(answered), len(novel))
+    if own_backend:
+        backend.close()
+    return aug_queries
+
+
+def estimate_back_translate(queries, num_aug=None, planner=None, cache=None, early_stop=True):
+    """
+    不发请求，估算回译一批语句需要的请求数和计费字符数：
+    中间语言按planner当前的产出率排序，early_stop时按产出率累计到num_aug条为止，否则用完所有可用语言；
+    正向结果已缓存时按缓存中的中间译文精确计算反向请求，否则按每次正向翻译对应一次等长的反向翻译估计
+    """
+    planner = planner or PivotPlanner(min_rate=0.0)
+    if cache is None:
+        cache = TranslationCache()
+    pivots = sorted([lan for lan in planner.lan_list if planner.usable(lan)], key=planner.rate, reverse=True)
+    unique = list(dict.fromkeys(queries))
+    result = collections.Counter(rows=len(queries), unique=len(unique))
+    for query in unique:
+        expected = 0.0
+        for lan in pivots:
+            if early_stop and num_aug is not None and expected >= num_aug:
+                break
+            expected += planner.rate(lan)
+            forward = cache.get(query, lan)
+            if forward is None:
+                result['forward_calls'] += 1
+                result['backward_calls'] += 1
+                result['chars'] += 2 * len(query)
+                continue
+            result['forward_hits'] += 1
+            for tmp_q in forward:
+                if cache.get(tmp_q, 'zh', lan) is None:
+                    result['backward_calls'] += 1
+                    result['chars'] += len(tmp_q)
+                else:
+                    result['backward_hits'] += 1
+    result['calls'] = result['forward_calls'] + result['backward_calls']
+    return result
+
+
+def back_translate(query, backend=None, num_aug=None):
+    return back_translate_batch([query], backend, num_aug)[0]
 
 
 if __name__ == '__main__':
     result = back_translate('帮我查一下航班信息')
     print(result)
+    report_errors()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+@File    :   stub_server.py
+@Time    :   2020/8/5
+@Software:   PyCharm
+@Author  :   Li Chen
+@Desc    :   本地模拟百度翻译接口(/api/trans/vip/translate)，支持延迟、限流和错误注入，用于离线压测回译流程
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+import collections
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+URL = '/api/trans/vip/translate'
+ERROR_MSG = {
+    '52001': 'TIMEOUT',
+    '52002': 'SYSTEM ERROR',
+    '52003': 'UNAUTHORIZED USER',
+    '54000': 'PARAM_FROM_TO_OR_Q_EMPTY',
+    '54001': 'INVALID SIGN',
+    '54003': 'Invalid Access Limit',
+    '54005': 'LONG QUERY FREQUENT',
+    '58001': 'INVALID TO LANGUAGE',
+}
+
+
+def fake_translate(query, toLang, novelty):
+    """
+    正向翻译给原句加上语言标记；反向翻译去掉标记，并按novelty的概率（由句子和语言确定）产生一个不同的"译文"
+    """
+    if toLang != 'zh':
+        return '<{}>{}'.format(toLang, query)
+    if query.startswith('<') and '>' in query:
+        lang, text = query[1:].split('>', 1)
+    else:
+        lang, text = 'auto', query
+    digest = int(hashlib.md5(query.encode()).hexdigest(), 16)
+    if digest % 1000 < novelty * 1000:
+        return '{}（{}）'.format(text, lang)
+    return text
+
+
+class StubState(object):
+    def __init__(self, args):
+        self.args = args
+        self.keys = dict(item.split(':', 1) for item in args.keys.split(',')) if args.keys else {}
+        self.error_codes = args.error_codes.split(',') if args.error_codes else []
+        self.stats = collections.Counter()
+        self._last = collections.defaultdict(collections.deque)
+        self._lock = threading.Lock()
+
+    def over_limit(self, appid):
+        # 每个appid独立限流：1秒窗口内请求数超过qps即返回54003
+        if self.args.qps <= 0:
+            return False
+        now = time.time()
+        with self._lock:
+            window = self._last[appid]
+            while window and now - window[0] >= 1.0:
+                window.popleft()
+            if len(window) >= self.args.qps:
+                return True
+            window.append(now)
+            return False
+
+    def handle(self, params):
+        query = params.get('q', '')
+        appid = params.get('appid', '')
+        toLang = params.get('to', '')
+        if not query or not toLang or not appid:
+            return '54000', None
+        if self.keys:
+            secret = self.keys.get(appid)
+            if secret is None:
+                return '52003', None
+            sign = hashlib.md5((appid + query + params.get('salt', '') + secret).encode()).hexdigest()
+            if sign != params.get('sign'):
+                return '54001', None
+        if self.error_codes and random.random() < self.args.error_rate:
+            return random.choice(self.error_codes), None
+        if self.over_limit(appid):
+            return '54003', None
+        lines = query.split('\n')
+        result = [{'src': line, 'dst': fake_translate(line, toLang, self.args.novelty)} for line in lines]
+        return '52000', {'from': params.get('from', 'auto'), 'to': toLang, 'trans_result': result}
+
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != URL:
+                self.send_error(404)
+                return
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+            delay = state.args.latency + random.uniform(0, state.args.jitter)
+            if delay > 0:
+                time.sleep(delay)
+            code, result = state.handle(params)
+            with state._lock:
+                state.stats[code] += 1
+            if result is None:
+                result = {'error_code': code, 'error_msg': ERROR_MSG.get(code, '')}
+            body = json.dumps(result, ensure_ascii=False).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(args):
+    state = StubState(args)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(state))
+    server.daemon_threads = True
+    return server, state
+
+
+def main():
+    parser = argparse.ArgumentParser(description='stub server of baidu translate api')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='监听地址')
+    parser.add_argument('--port', type=int, default=8000, help='监听端口')
+    parser.add_argument('--latency', type=float, default=0.05, help='每个请求的固定延迟(秒)')
+    parser.add_argument('--jitter', type=float, default=0.05, help='在固定延迟上附加的随机延迟上限(秒)')
+    parser.add_argument('--qps', type=float, default=1.0, help='每个appid的QPS上限，超出返回54003，<=0不限流')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='随机注入错误的概率')
+    parser.add_argument('--error_codes', type=str, default='52001,54003', help='注入的错误码，逗号分隔')
+    parser.add_argument('--novelty', type=float, default=0.6, help='回译结果与原句不同的概率')
+    parser.add_argument('--keys', type=str, default='',
+                        help='appid:secret，逗号分隔，配置后校验签名；为空不校验')
+    args = parser.parse_args()
+
+    server, state = serve(args)
+    print('stub server listening on {}:{}{}'.format(args.host, args.port, URL))
+    start = time.time()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    elapsed = time.time() - start
+    total = sum(state.stats.values())
+    print('served {} requests in {:.1f}s ({:.2f} QPS)'.format(total, elapsed, total / max(elapsed, 1e-6)))
+    for code, count in sorted(state.stats.items()):
+        print('  {}\t{}'.format(code, count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+@File    :   pruned_embedding.py
+@Time    :   2020/8/20
+@Software:   PyCharm
+@Author  :   Li Chen
+@Desc    :   只保留有预训练向量的词的冻结embedding，随checkpoint单独保存，用于推理；未登录词不做hash分桶，共用一行零向量（这些词训练时的向量全为零）
+"""
+
+import numpy as np
+import torch
+
+SPECIALS = ['<unk>', '<pad>']
+
+
+class PrunedEmbedding(object):
+    """
+    词表只保留<unk>、<pad>和预训练向量非零的词；其余词（包括训练时词表中没有向量的词和推理时的新词）
+    都映射到最后一行零向量。这些词训练时的向量本来就是零且embedding冻结，默认按模型的float32保存，模型输出不变
+    """
+    def __init__(self, itos, vectors):
+        self.itos = list(itos)
+        self.stoi = {token: i for i, token in enumerate(self.itos)}
+        self.vectors = vectors
+        self.pad_id = self.stoi['<pad>']
+
+    @classmethod
+    def from_vocab(cls, itos, vectors):
+        vectors = vectors.detach().cpu().numpy() if isinstance(vectors, torch.Tensor) else np.asarray(vectors)
+        nonzero = np.abs(vectors).sum(axis=1) > 0
+        keep = [i for i, token in enumerate(itos) if token in SPECIALS or nonzero[i]]
+        oov = np.zeros((1, vectors.shape[1]), dtype=vectors.dtype)
+        return cls([itos[i] for i in keep], np.concatenate([vectors[keep], oov], 0))
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    def lookup(self, token):
+        # 未登录词对应itos之后的零向量行
+        return self.stoi.get(token, len(self.itos))
+
+    def weight(self):
+        return torch.from_numpy(self.vectors.astype(np.float32))
+
+    def save(self, path, dtype=None):
+        """
+        dtype为空时按向量原来的精度保存；float16可使文件减半，但推理时的embedding随之变为半精度取整后的值
+        """
+        with open(path, 'wb') as f:
+            np.savez(f, itos=np.array(self.itos), vectors=self.vectors.astype(dtype or self.vectors.dtype))
+
+    @classmethod
+    def load(cls, path):
+        store = np.load(path)
+        return cls(store['itos'].tolist(), store['vectors'])
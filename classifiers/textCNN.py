@@ -9,12 +9,32 @@
 @Desc    :
 """
 
+import random
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from mixup import text_mixup as tm
 
 
+# 可做mixup的层：word为embedding输出，conv为各卷积分支池化前的输出，sen为池化拼接后、全连接前的句向量
+MIX_LAYERS = ['word', 'conv', 'sen']
+
+
+def parse_mix_layers(mixup):
+    """
+    mixup为None、单个层名、逗号分隔的多个层名，或manifold（全部层）
+    """
+    if not mixup or mixup.lower() == 'none':
+        return []
+    if mixup == 'manifold':
+        return list(MIX_LAYERS)
+    layers = [layer.strip() for layer in mixup.split(',')]
+    for layer in layers:
+        if layer not in MIX_LAYERS:
+            raise ValueError('unknown mixup layer: {}, choose from {}'.format(layer, MIX_LAYERS))
+    return layers
+
+
 class TextCNN(nn.Module):
     def __init__(self, args):
         super(TextCNN, self).__init__()
@@ -33,22 +53,182 @@ class TextCNN(nn.Module):
             [nn.Conv2d(channel_num, filter_num, (size, embedding_dimension)) for size in filter_sizes])
         self.dropout = nn.Dropout(args.dropout)
         self.fc = nn.Linear(len(filter_sizes)*filter_num, class_num)
+        self.lam_sampler = tm.LamSampler(args.alpha)
+        self.mix_layers = parse_mix_layers(args.mixup)
+        # 旧checkpoint的args没有pad_id，torchtext词表中<pad>为1
+        self.pad_id = getattr(args, 'pad_id', 1)
+        # conv1d各输出通道对应的卷积核大小，随模型放到device上，每步构造mask时不再从host拷贝；不存入state_dict
+        self.register_buffer('channel_sizes', torch.tensor(filter_sizes).repeat_interleave(filter_num), persistent=False)
+        self._fused = None
+
+    def pad_to_filters(self, x):
+        """
+        batch中最长的句子短于最大卷积核时，在右侧用<pad>补到最大卷积核的长度；只看张量形状，不与device同步
+        """
+        if x.size()[1] < max(self.args.filter_sizes):
+            x = F.pad(x, (0, max(self.args.filter_sizes) - x.size()[1]), value=self.pad_id)
+        return x
 
-    def forward(self, x, is_training=False):
-        x = self.embedding(x)
+    def forward(self, x, is_training=False, lengths=None):
+        """
+        训练时从mix_layers中随机选一层做mixup，混合样本只从该层开始计算，下面的层不重复计算；
+        batch已由collate补齐到最长句子，这里只在其短于最大卷积核时用<pad>补长；给出lengths时word mixup只在真实token上混合
+        --return: logits和mixup信息；mixup_pairing为split时为lam，为perm时为(lam, index)
+        """
+        layer = random.choice(self.mix_layers) if is_training and self.mix_layers else None
         lam = None
-        if is_training and self.args.mixup == 'word':
-            batch_mix_index = int(x.size()[0] * self.args.rate_mixup)
-            x_mix, lam = tm.wordMixup(x[:batch_mix_index, :, :], x[-batch_mix_index:, :, :], self.args.alpha)
-            x = torch.cat((x, x_mix), 0)
-        x = x.unsqueeze(1)
-        x = [F.relu(conv(x)).squeeze(3) for conv in self.convs]
-        x = [F.max_pool1d(item, item.size(2)).squeeze(2) for item in x]
+        x = self.embedding(self.pad_to_filters(x))
+        if layer == 'word':
+            (x,), lam = self.mixup([x], lengths)
+        if self.args.conv_impl == 'conv2d':
+            x = self.conv2d(x)
+        else:
+            x = self.conv1d(x)
+        if layer == 'conv':
+            x, lam = self.mixup(x)
+        x = [F.adaptive_max_pool1d(item, 1).squeeze(2) for item in x]
         x = torch.cat(x, 1)
-        if is_training and self.args.mixup == 'sen':
-            batch_mix_index = int(x.size()[0] * self.args.rate_mixup)
-            x_mix, lam = tm.sentenceMixup(x[:batch_mix_index, :], x[-batch_mix_index:, :], self.args.alpha)
-            x = torch.cat((x, x_mix), 0)
+        if layer == 'sen':
+            (x,), lam = self.mixup([x])
         x = self.dropout(x)
         logits = self.fc(x)
         return logits, lam
+
+    def conv2d(self, x):
+        """
+        [B, L, D] -> 每个卷积分支一个[B, F, L-size+1]
+        """
+        x = x.unsqueeze(1)
+        return [F.relu(conv(x)).squeeze(3) for conv in self.convs]
+
+    def conv1d(self, x):
+        """
+        与conv2d等价的单次Conv1d：各分支的Conv2d权重[F, 1, size, D]转为[F, D, size]，在右侧补零到最大卷积核后拼成一个卷积，
+        输入右侧补(max-min)个零使最小卷积核的输出位置都能算到，再把每个分支超出L-size+1的位置置零（relu后最大值不小于0，不影响池化）。
+        参数仍保存在self.convs中，与已有checkpoint兼容
+        [B, L, D] -> [[B, n*F, L-min+1]]
+        """
+        sizes = self.args.filter_sizes
+        max_size, min_size = max(sizes), min(sizes)
+        weight, bias = self.fused_conv1d_weight()
+        seq_len = x.size()[1]
+        x = F.pad(x.transpose(1, 2), (0, max_size - min_size))
+        x = F.relu(F.conv1d(x, weight, bias))
+        valid_len = seq_len + 1 - self.channel_sizes
+        mask = torch.arange(x.size()[2], device=x.device).unsqueeze(0) < valid_len.unsqueeze(1)
+        return [x.masked_fill(~mask, 0)]
+
+    def fused_conv1d_weight(self):
+        """
+        把各分支的Conv2d权重拼成conv1d的[n*F, D, max]权重和[n*F]偏置。评估和推理（eval且不求梯度）时缓存结果，
+        卷积参数的存储或版本号变化（optimizer.step、load_state_dict、.to(device)）后重新拼接；训练时每步重新拼接以传递梯度
+        """
+        cacheable = not self.training and not torch.is_grad_enabled()
+        key = tuple((p.data_ptr(), p._version) for p in self.convs.parameters()) if cacheable else None
+        if cacheable and self._fused is not None and self._fused[0] == key:
+            return self._fused[1]
+        max_size = max(self.args.filter_sizes)
+        weight = torch.cat([F.pad(conv.weight.squeeze(1).transpose(1, 2), (0, max_size - conv.weight.size()[2]))
+                            for conv in self.convs], 0)
+        bias = torch.cat([conv.bias for conv in self.convs], 0)
+        self._fused = (key, (weight, bias)) if cacheable else None
+        return weight, bias
+
+    def mixup(self, xs, lengths=None):
+        return tm.hiddenMixup(xs, self.args.alpha, self.args.rate_mixup, self.args.mixup_pairing, self.lam_sampler,
+                              lengths)
+
+
+class TextCNNExport(nn.Module):
+    """
+    推理用的TextCNN：去掉dropout和mixup，卷积改写为对滑动窗口的nn.Linear（权重即Conv2d权重展平），
+    从而可以用quantize_dynamic把卷积和全连接一起做INT8动态量化；embedding可存为float16以减小模型体积。
+    短于最大卷积核的输入用<pad>补长，因此用torch.jit.script导出，trace会把这个分支固定下来
+    """
+    def __init__(self, model, half_embedding=False):
+        super(TextCNNExport, self).__init__()
+        self.pad_id = model.pad_id
+        self.max_size = max(model.args.filter_sizes)
+        weight = model.embedding.weight.detach()
+        self.embedding = nn.Embedding.from_pretrained(weight.half() if half_embedding else weight, freeze=True)
+        self.filter_sizes = list(model.args.filter_sizes)
+        self.convs = nn.ModuleList()
+        for conv in model.convs:
+            filter_num, _, size, dim = conv.weight.size()
+            linear = nn.Linear(size * dim, filter_num)
+            linear.weight.data.copy_(conv.weight.detach().view(filter_num, size * dim))
+            linear.bias.data.copy_(conv.bias.detach())
+            self.convs.append(linear)
+        self.fc = model.fc
+
+    def forward(self, x):
+        if x.size(1) < self.max_size:
+            x = torch.cat([x, x.new_full((x.size(0), self.max_size - x.size(1)), self.pad_id)], 1)
+        x = self.embedding(x).float()
+        pooled = []
+        for i, linear in enumerate(self.convs):
+            size = self.filter_sizes[i]
+            # [B, L, D] -> [B, L-size+1, D, size] -> [B, L-size+1, size*D]
+            windows = x.unfold(1, size, 1).transpose(2, 3)
+            windows = windows.reshape(windows.size(0), windows.size(1), -1)
+            pooled.append(F.relu(linear(windows)).max(1)[0])
+        return self.fc(torch.cat(pooled, 1))
+
+
+def export_torchscript(model, path=None, quantize=False, half_embedding=False):
+    """
+    导出TorchScript模型，quantize时对卷积(Linear形式)和全连接做INT8动态量化
+    --return: torch.jit.ScriptModule，输入[B, L]的token id，输出logits
+    """
+    module = TextCNNExport(model, half_embedding)
+    module.eval()
+    if quantize:
+        module = torch.quantization.quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8)
+    with torch.no_grad():
+        scripted = torch.jit.script(module)
+    if path:
+        torch.jit.save(scripted, path)
+    return scripted
+
+
+def benchmark(batch_size=64, seq_len=64, vocabulary_size=5000, embedding_dim=300, repeat=20):
+    """
+    校验conv1d与conv2d实现的输出一致，并对比CPU上训练(forward+backward)和推理的吞吐
+    """
+    import argparse
+    import time
+    args = argparse.Namespace(class_num=2, filter_num=100, filter_sizes=[3, 4, 5], vocabulary_size=vocabulary_size,
+                              embedding_dim=embedding_dim, vectors=torch.randn(vocabulary_size, embedding_dim),
+                              dropout=0.5, alpha=1.0, mixup=None, rate_mixup=0.5, mixup_pairing='split',
+                              conv_impl='conv2d')
+    model = TextCNN(args)
+    model.eval()
+    x = torch.randint(vocabulary_size, (batch_size, seq_len))
+    with torch.no_grad():
+        args.conv_impl = 'conv2d'
+        ref, _ = model(x)
+        args.conv_impl = 'conv1d'
+        out, _ = model(x)
+    assert torch.allclose(ref, out, atol=1e-4), (ref - out).abs().max()
+    for conv_impl in ('conv2d', 'conv1d'):
+        args.conv_impl = conv_impl
+        model.train()
+        start = time.time()
+        for _ in range(repeat):
+            model.zero_grad()
+            logits, _ = model(x)
+            logits.sum().backward()
+        train_speed = batch_size * repeat / (time.time() - start)
+        model.eval()
+        start = time.time()
+        with torch.no_grad():
+            for _ in range(repeat):
+                model(x)
+        infer_speed = batch_size * repeat / (time.time() - start)
+        print('{}\ttrain {:.0f} samples/s\tinference {:.0f} samples/s'.format(conv_impl, train_speed, infer_speed))
+
+
+if __name__ == '__main__':
+    for batch_size, seq_len in ((20, 32), (64, 64), (128, 128)):
+        print('batch={} seq_len={}'.format(batch_size, seq_len))
+        benchmark(batch_size, seq_len)
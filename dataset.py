@@ -14,6 +14,8 @@ from torchtext import data
 import jieba
 
 regex = re.compile(r'[^\u4e00-\u9fa5aA-Za-z0-9]')
+# 修改tokenizer时加一，token_cache中的分词缓存随之失效
+TOKENIZER_VERSION = 1
 
 
 def tokenizer(text):
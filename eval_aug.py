@@ -11,113 +11,328 @@
 
 import argparse
 import os
+import random
 import sys
+import time
+import numpy as np
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 import torch.nn.functional as F
+from torch.nn.parallel import DistributedDataParallel
 from torchtext import data
 from torchtext.vocab import Vectors
-from classifiers.textCNN import TextCNN
+from classifiers.textCNN import TextCNN, export_torchscript
+from classifiers.pruned_embedding import PrunedEmbedding
 import dataset
+import token_cache
+import word_vectors
 from mixup import text_mixup as tm
 
 
+class RunningMetrics(object):
+    """
+    在device上累加loss、正确数等指标，只在summary()时同步一次，并统计这段时间的steps/s和samples/s；
+    exclude()去掉中间评估等不属于训练的时间
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.sums = {}
+        self.steps = 0
+        self.samples = 0
+        self.start = time.time()
+
+    def add(self, samples, **values):
+        self.steps += 1
+        self.samples += samples
+        for name, value in values.items():
+            value = value.detach() if torch.is_tensor(value) else torch.tensor(value)
+            self.sums[name] = self.sums[name] + value if name in self.sums else value
+
+    def exclude(self, seconds):
+        self.start += seconds
+
+    def summary(self):
+        names = list(self.sums)
+        values = torch.stack([self.sums[name].double().cpu() for name in names]).tolist() if names else []
+        result = dict(zip(names, values))
+        elapsed = max(time.time() - self.start, 1e-9)
+        result.update(steps=self.steps, samples=self.samples,
+                      steps_per_sec=self.steps / elapsed, samples_per_sec=self.samples / elapsed)
+        return result
+
+
 def train(train_iter, val_iter, model, args):
+    """
+    model为DistributedDataParallel时只有rank 0评估和保存checkpoint，其余进程在下一次梯度同步处等待；
+    训练吞吐（不含评估时间，所有进程的样本数之和）记录在args.train_throughput
+    """
     optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+    module = model.module if isinstance(model, DistributedDataParallel) else model
     steps = 0
     best_acc = 0
     model.train()
+    interval_metrics, epoch_metrics = RunningMetrics(), RunningMetrics()
+    train_start, eval_time, train_samples = time.time(), 0.0, 0
+    # 每个batch和epoch的日志只统计本进程（rank 0），最后的Training吞吐为所有进程之和
+    scope = ' on rank 0' if args.nproc > 1 else ''
     for epoch in range(1, args.epochs+1):
+        epoch_metrics.reset()
+        token_cache.set_epoch(train_iter, epoch)
         for batch in train_iter:
-            feature, target = batch.text, batch.label
+            (feature, lengths), target = batch.text, batch.label
+            epoch_metrics.add(batch.batch_size, real_tokens=lengths.sum(), padded_tokens=feature.numel())
             feature.t_()
             target.data.sub_(1)
             optimizer.zero_grad()
 
-            if args.mixup:
+            if args.mixup and args.mixup_pairing == 'perm':
+                logits, (lam, index) = model(feature, is_training=True, lengths=lengths)
+                loss = tm.loss_mixup_perm(logits, target, index, lam)
+            elif args.mixup:
                 batch_mix_index = int(target.size()[0] * args.rate_mixup)
-                logits, lam = model(feature, is_training=True)
-                loss = tm.loss_mixup(logits, target, batch_mix_index, lam)
-                logits = logits[:-batch_mix_index]
+                logits, lam = model(feature, is_training=True, lengths=lengths)
+                if lam is None:
+                    # batch太小，hiddenMixup没有追加混合样本，这一步按普通样本训练
+                    loss = F.cross_entropy(logits, target)
+                else:
+                    loss = tm.loss_mixup(logits, target, batch_mix_index, lam)
+                    logits = logits[:-batch_mix_index]
             else:
-                logits, _ = model(feature)
+                logits, _ = model(feature, lengths=lengths)
                 loss = F.cross_entropy(logits, target)
 
             loss.backward()
             optimizer.step()
             steps += 1
+            interval_metrics.add(batch.batch_size, loss=loss * batch.batch_size,
+                                 corrects=(torch.max(logits, 1)[1].view(target.size()) == target).sum())
             if steps % args.log_interval == 0:
-                corrects = (torch.max(logits, 1)[1].view(target.size()).data == target.data).sum()
-                train_acc = 1.0 * corrects / batch.batch_size
-                sys.stdout.write(
-                    'Batch[{}] - loss: {:.6f}  acc: {:.4f} ({}/{})'.format(steps,
-                                                                             loss.item(),
-                                                                             train_acc,
-                                                                             corrects,
-                                                                             batch.batch_size))
-            if steps % args.eval_interval == 0:
-                val_acc = eval(val_iter, model, args)
+                metrics = interval_metrics.summary()
+                print('Batch[{}] - loss: {:.6f}  acc: {:.4f} ({}/{})  {:.2f} steps/s  {:.1f} samples/s{}'.format(
+                    steps, metrics['loss'] / metrics['samples'], metrics['corrects'] / metrics['samples'],
+                    int(metrics['corrects']), metrics['samples'], metrics['steps_per_sec'], metrics['samples_per_sec'],
+                    scope))
+                interval_metrics.reset()
+            if steps % args.eval_interval == 0 and args.rank == 0:
+                eval_start = time.time()
+                val_acc = eval(val_iter, module, args)
                 if val_acc > best_acc:
                     best_acc = val_acc
                     if args.save_checkpoint:
                         print('Saving best model, acc: {:.4f}\n'.format(best_acc))
-                        save(model, args.save_dir, 'best', steps)
-    print(best_acc.item())
+                        save(module, args.save_dir, 'best', steps)
+                elapsed = time.time() - eval_start
+                eval_time += elapsed
+                interval_metrics.exclude(elapsed)
+                epoch_metrics.exclude(elapsed)
+        train_samples += epoch_metrics.samples
+        metrics = epoch_metrics.summary()
+        print('\nEpoch[{}] - {:.1f} samples/s  padding: {:.2%} of {} tokens{}'.format(
+            epoch, metrics['samples_per_sec'], 1 - metrics['real_tokens'] / max(metrics['padded_tokens'], 1),
+            int(metrics['padded_tokens']), scope))
+    train_time = time.time() - train_start - eval_time
+    if dist.is_initialized():
+        total = torch.tensor([train_samples], dtype=torch.long)
+        dist.all_reduce(total)
+        train_samples = int(total)
+    args.train_throughput = train_samples / max(train_time, 1e-9)
+    print('\nTraining - {:.1f} samples/s over {} process(es)'.format(args.train_throughput, args.nproc))
+    print(best_acc)
+    return best_acc
 
 
 def eval(data_iter, model, args):
+    """
+    按eval_batch_size分块评估，loss和正确数用RunningMetrics在device上累加，结束时只同步一次；评估后恢复原来的train/eval模式
+    """
+    training = model.training
     model.eval()
-    corrects, avg_loss = 0, 0
-    for batch in data_iter:
-        feature, target = batch.text, batch.label
-        feature.t_()
-        target.data.sub_(1)
-        logits, _ = model(feature)
-        loss = F.cross_entropy(logits, target)
-        avg_loss += loss.item()
-        corrects += (torch.max(logits, 1)
-                     [1].view(target.size()).data == target.data).sum()
+    metrics = RunningMetrics()
+    with torch.no_grad():
+        for batch in data_iter:
+            (feature, lengths), target = batch.text, batch.label
+            feature.t_()
+            target.data.sub_(1)
+            logits, _ = model(feature, lengths=lengths)
+            metrics.add(batch.batch_size, loss=F.cross_entropy(logits, target, reduction='sum'),
+                        corrects=(torch.max(logits, 1)[1].view(target.size()) == target).sum())
+    metrics = metrics.summary()
     size = len(data_iter.dataset)
-    avg_loss /= size
-    accuracy = 1.0 * corrects / size
-    print('\nEvaluation - loss: {:.6f}  acc: {:.4f} ({}/{}) \n'.format(avg_loss,
-                                                                       accuracy,
-                                                                       corrects,
-                                                                       size))
+    avg_loss = metrics.get('loss', 0.0) / size
+    accuracy = metrics.get('corrects', 0.0) / size
+    print('\nEvaluation - loss: {:.6f}  acc: {:.4f} ({}/{})  {:.1f} samples/s\n'.format(avg_loss,
+                                                                                      accuracy,
+                                                                                      int(metrics.get('corrects', 0)),
+                                                                                      size,
+                                                                                      metrics['samples_per_sec']))
+    model.train(training)
     return accuracy
 
 
+# 重建TextCNN所需的超参数，随checkpoint一起保存
+MODEL_ARGS = ['class_num', 'filter_num', 'filter_sizes', 'vocabulary_size', 'embedding_dim', 'dropout', 'conv_impl']
+
+
 def save(model, save_dir, prefix, steps):
+    """
+    checkpoint包含模型参数、超参数以及词表和标签表，predict.py可直接加载；
+    prune_embedding时词表和裁剪后的embedding另存为同名的.emb.npz，checkpoint中不再包含embedding
+    """
     if not os.path.isdir(save_dir):
         os.makedirs(save_dir)
     save_prefix = os.path.join(save_dir, prefix)
     save_path = '{}_steps_{}.pt'.format(save_prefix, steps)
-    torch.save(model.state_dict(), save_path)
+    checkpoint = {
+        'state_dict': model.state_dict(),
+        'args': {name: getattr(model.args, name) for name in MODEL_ARGS},
+        'vocab': model.args.vocab_itos,
+        'labels': model.args.label_itos,
+    }
+    if model.args.prune_embedding:
+        store = PrunedEmbedding.from_vocab(model.args.vocab_itos, model.embedding.weight)
+        store_path = '{}_steps_{}.emb.npz'.format(save_prefix, steps)
+        store.save(store_path, 'float16' if model.args.prune_embedding_half else None)
+        del checkpoint['state_dict']['embedding.weight']
+        checkpoint['vocab'] = None
+        checkpoint['embedding'] = os.path.basename(store_path)
+    torch.save(checkpoint, save_path)
 
 
-def load_word_vectors(w2v_name, w2v_path):
+def load_state_dict(snapshot):
+    """
+    兼容只保存了state_dict的旧checkpoint
+    """
+    checkpoint = torch.load(snapshot, map_location='cpu')
+    return checkpoint['state_dict'] if 'state_dict' in checkpoint else checkpoint
+
+
+def export(model, val_iter, args):
+    """
+    导出float和INT8动态量化两个TorchScript模型，在测试集上对比准确率、吞吐和文件大小
+    """
+    if not os.path.isdir(args.export_dir):
+        os.makedirs(args.export_dir)
+    model.eval()
+    print('\n{:<8}{:>10}{:>16}{:>12}'.format('model', 'acc', 'samples/s', 'size(MB)'))
+    for name, quantize in (('float', False), ('int8', True)):
+        path = os.path.join(args.export_dir, 'textcnn_{}.pt'.format(name))
+        scripted = export_torchscript(model, path, quantize=quantize, half_embedding=args.export_half_embedding)
+        corrects, size, elapsed = 0, 0, 0.0
+        with torch.no_grad():
+            for batch in val_iter:
+                (feature, _), target = batch.text, batch.label
+                feature.t_()
+                target.data.sub_(1)
+                start = time.time()
+                logits = scripted(feature)
+                elapsed += time.time() - start
+                corrects += (torch.max(logits, 1)[1].view(target.size()) == target).sum().item()
+                size += target.size()[0]
+        print('{:<8}{:>10.4f}{:>16.0f}{:>12.1f}'.format(name, corrects / size, size / max(elapsed, 1e-9),
+                                                      os.path.getsize(path) / 1024 / 1024))
+
+
+def load_word_vectors(w2v_name, w2v_path, binary=False, dtype='float32'):
+    if binary:
+        return word_vectors.load(w2v_name, w2v_path, dtype)
     vectors = Vectors(name=w2v_name, cache=w2v_path)
     return vectors
 
 
-def load_dataset(text_field, label_field, args, **kwargs):
+class TokenBudget(object):
+    """
+    torchtext的batch_size_fn：按padding后的token数（样本数 * batch内最长样本长度）计算batch大小
+    """
+    def __init__(self):
+        self.max_len = 0
+
+    def __call__(self, example, count, size_so_far):
+        if count == 1:
+            self.max_len = 0
+        self.max_len = max(self.max_len, len(example.text))
+        return count * self.max_len
+
+
+def vocab_vectors(itos, vectors):
+    # 与torchtext Vocab.load_vectors相同：逐词取向量，没有预训练向量的词为零向量
+    return torch.stack([vectors[token] for token in itos])
+
+
+def load_cached_dataset(args, w2v=None, device=None):
+    """
+    从token_cache读取已分词的数据，不经过torchtext；缓存按文件内容、分词器版本和词表设置区分。
+    训练集由--num_workers个worker进程读取和padding，与训练循环并行
+    """
+    itos, label_itos, train_dataset, val_dataset = token_cache.load(args.train_file, args.test_file, args.cache_dir)
+    vectors = w2v if w2v is not None else load_word_vectors(args.w2v_name, args.w2v_path, args.w2v_binary,
+                                                            args.w2v_dtype)
+    pad_id = itos.index('<pad>')
+    # 多进程训练时每个进程只读取训练集的1/nproc，测试集只由rank 0评估
+    train_iter = token_cache.make_loader(train_dataset, pad_id, args.batch_size, shuffle=True,
+                                         bucket=args.bucket, max_tokens=args.max_tokens,
+                                         num_workers=args.num_workers, prefetch_factor=args.prefetch_factor,
+                                         device=device, num_replicas=args.nproc, rank=args.rank)
+    val_iter = token_cache.make_loader(val_dataset, pad_id, args.eval_batch_size, device=device)
+    return train_iter, val_iter, itos, label_itos, vocab_vectors(itos, vectors)
+
+
+def load_dataset(args, w2v=None, **kwargs):
+    """
+    --return: 训练和测试batch迭代器、词表、标签表、词表对应的词向量矩阵
+    """
+    if args.token_cache:
+        return load_cached_dataset(args, w2v, kwargs.get('device'))
+    text_field = data.Field(lower=True, include_lengths=True)
+    label_field = data.Field(sequential=False)
     train_dataset, val_dataset = dataset.make_dataset(args.train_file, args.test_file, text_field, label_field)
-    vectors = load_word_vectors(args.w2v_name, args.w2v_path)
+    vectors = w2v if w2v is not None else load_word_vectors(args.w2v_name, args.w2v_path, args.w2v_binary,
+                                                            args.w2v_dtype)
     text_field.build_vocab(train_dataset, val_dataset, vectors=vectors)
     label_field.build_vocab(train_dataset, val_dataset)
-    train_iter, val_iter = data.Iterator.splits(
-        (train_dataset, val_dataset),
-        batch_sizes=(args.batch_size, len(val_dataset)),
+    if not args.bucket:
+        train_iter, val_iter = data.Iterator.splits(
+            (train_dataset, val_dataset),
+            batch_sizes=(args.batch_size, args.eval_batch_size),
+            sort_key=lambda x: len(x.text),
+            **kwargs)
+        return train_iter, val_iter, text_field.vocab.itos, label_field.vocab.itos, text_field.vocab.vectors
+    # 按长度分桶：每100个batch的样本为一个池，池内按长度排序后切batch，batch顺序再打乱，每个batch只补齐到自己的最长样本
+    train_iter = data.BucketIterator(
+        train_dataset,
+        batch_size=args.max_tokens or args.batch_size,
+        batch_size_fn=TokenBudget() if args.max_tokens else None,
         sort_key=lambda x: len(x.text),
+        sort_within_batch=True,
         **kwargs)
-    return train_iter, val_iter
+    val_iter = data.Iterator(val_dataset, batch_size=args.eval_batch_size, sort_key=lambda x: len(x.text),
+                             train=False, **kwargs)
+    return train_iter, val_iter, text_field.vocab.itos, label_field.vocab.itos, text_field.vocab.vectors
 
 
-def main():
+def str2bool(value):
+    # argparse的type=bool会把'False'当成True
+    if value.lower() in ('true', 'yes', '1'):
+        return True
+    if value.lower() in ('false', 'no', '0'):
+        return False
+    raise argparse.ArgumentTypeError('expected True or False, got {}'.format(value))
+
+
+def build_parser():
     parser = argparse.ArgumentParser(description='text classifier')
     # learning
     parser.add_argument('--lr', type=float, default=0.001, help='initial learning rate [default: 0.001]')
     parser.add_argument('--epochs', type=int, default=5, help='number of epochs for train [default: 256]')
     parser.add_argument('--batch_size', type=int, default=20, help='batch size for training [default: 128]')
+    parser.add_argument('--eval_batch_size', type=int, default=1000,
+                        help='batch size for evaluation, the test set is evaluated in chunks [default: 1000]')
+    parser.add_argument('--bucket', action='store_true',
+                        help='batch training samples of similar length together to reduce padding [default: False]')
+    parser.add_argument('--max_tokens', type=int, default=None,
+                        help='with --bucket, limit each batch by padded tokens instead of --batch_size [default: None]')
     parser.add_argument('--log_interval', type=int, default=5,
                         help='how many steps to wait before logging training status [default: 1]')
     parser.add_argument('--eval_interval', type=int, default=5,
@@ -131,43 +346,184 @@ def main():
     parser.add_argument('--filter_num', type=int, default=100, help='number of each size of filter')
     parser.add_argument('--filter_sizes', type=str, default='3,4,5',
                         help='comma-separated filter sizes to use for convolution')
+    parser.add_argument('--conv_impl', type=str, default='conv1d',
+                        help='conv1d: all filter sizes fused into one Conv1d, conv2d: one Conv2d per filter size; '
+                             'both share the same parameters [default: conv1d]')
     # load file
     parser.add_argument('--w2v_name', type=str, default='sgns.wiki.word',
                         help='filename of pre-trained word vectors')
     parser.add_argument('--w2v_path', type=str, default='data/', help='path of pre-trained word vectors')
+    parser.add_argument('--w2v_binary', type=str2bool, default=True,
+                        help='convert word vectors once to a memory-mapped .npy cache and load only the rows '
+                             'of the vocabulary [default: True]')
+    parser.add_argument('--w2v_dtype', type=str, default='float32',
+                        help='dtype of the binary cache, float32 or float16 [default: float32]')
     parser.add_argument('--train_file', type=str, required=True, help='path of train set')
     parser.add_argument('--test_file', type=str, required=True, help='path of test set')
+    parser.add_argument('--token_cache', type=str2bool, default=True,
+                        help='tokenize train/test sets once and load token ids from a memory-mapped cache, '
+                             'without torchtext; false uses the torchtext TabularDataset pipeline [default: True]')
+    parser.add_argument('--cache_dir', type=str, default='data/cache/', help='where to keep tokenized datasets')
     # device
     parser.add_argument('--device', type=int, default=-1,
                      help='device to use for iterate data, -1 mean cpu [default: -1]')
+    parser.add_argument('--num_workers', type=int, default=2,
+                        help='worker processes that read and pad training batches from the token cache, '
+                             '0 to load in the training process [default: 2]')
+    parser.add_argument('--prefetch_factor', type=int, default=2,
+                        help='batches prefetched by each worker [default: 2]')
+    parser.add_argument('--nproc', type=int, default=1,
+                        help='data-parallel training processes on this machine, gradients are averaged with '
+                             'torch.distributed over gloo; needs --token_cache [default: 1]')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='torch threads per training process [default: cores divided by nproc]')
+    parser.add_argument('--master_port', type=int, default=29500, help='port of the gloo rendezvous [default: 29500]')
+    parser.add_argument('--scaling', type=str, default=None,
+                        help='comma-separated process counts such as 1,2,4,8: train once with each and report '
+                             'throughput, speedup and scaling efficiency [default: None]')
     # option
     parser.add_argument('--snapshot', type=str, default=None, help='filename of model snapshot [default: None]')
+    parser.add_argument('--prune_embedding', type=str2bool, default=False,
+                        help='save only vectors of tokens with pre-trained vectors, next to the checkpoint; other '
+                             'tokens share a single zero row [default: False]')
+    parser.add_argument('--prune_embedding_half', type=str2bool, default=False,
+                        help='save the pruned vectors in float16, half the size but predictions may change slightly '
+                             '[default: False]')
+    parser.add_argument('--export_dir', type=str, default=None,
+                        help='export float and int8 TorchScript models after training and compare them on the test set')
+    parser.add_argument('--export_half_embedding', type=str2bool, default=False,
+                        help='store the frozen embedding of exported models in float16 [default: False]')
     # isMixup
-    parser.add_argument('--mixup', type=str, default=None, help='the method of textMixup [default: None]')
+    parser.add_argument('--mixup', type=str, default=None,
+                        help='layers to apply textMixup, one of word/conv/sen, a comma-separated list of them '
+                             'chosen at random per step, or manifold for all [default: None]')
     parser.add_argument('--rate_mixup', type=float, default=0.5, help='the rate of mixup data [default: 0.5]')
     parser.add_argument('--alpha', type=float, default=1.0, help='hyper-parameter [default: 1.0]')
+    parser.add_argument('--mixup_pairing', type=str, default='split',
+                        help='split: mix the head of the batch with its tail and append the mixed samples; '
+                             'perm: mix every sample with a random permutation of the batch in place [default: split]')
+    parser.add_argument('--seed', type=int, default=None, help='random seed of python, numpy and torch [default: None]')
+    return parser
+
+
+def set_seed(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
 
-    args = parser.parse_args()
+
+def run(args, w2v=None):
+    """
+    按args训练并评估一次，返回测试集上的最优准确率；w2v为已加载的词向量（run_experiments在多个实验间共享），为空时按args加载
+    """
+    if args.mixup and args.mixup.lower() == 'none':
+        args.mixup = None
+    args.rank = dist.get_rank() if dist.is_initialized() else 0
+    if args.nproc > 1 and not dist.is_initialized():
+        # 直接调用run()时没有进程组，模型不会包装成DDP，单进程读取1/nproc的数据并按nproc倍统计样本数
+        raise ValueError('--nproc > 1 must be started with launch(), which spawns the processes and joins them')
+    if args.nproc > 1 and not args.token_cache:
+        raise ValueError('--nproc > 1 needs the token cache, do not pass --token_cache false')
+    if args.seed is not None:
+        # 模型初始参数由DDP从rank 0广播，各进程的dropout和mixup使用不同的随机数
+        set_seed(args.seed + args.rank)
     print('Loading data...')
-    text_field = data.Field(lower=True)
-    label_field = data.Field(sequential=False)
-    train_iter, val_iter = load_dataset(text_field, label_field, args, repeat=False, shuffle=True)
+    device = torch.device('cuda', args.device) if args.device >= 0 else torch.device('cpu')
+    train_iter, val_iter, vocab_itos, label_itos, vectors = load_dataset(args, w2v, repeat=False, shuffle=True,
+                                                                         device=device)
 
-    args.vocabulary_size = len(text_field.vocab)
-    args.embedding_dim = text_field.vocab.vectors.size()[-1]
-    args.vectors = text_field.vocab.vectors
-    args.class_num = len(label_field.vocab)
+    args.vocabulary_size = len(vocab_itos)
+    args.embedding_dim = vectors.size()[-1]
+    args.vectors = vectors
+    args.class_num = len(label_itos)
+    args.vocab_itos = vocab_itos
+    args.label_itos = label_itos
+    args.pad_id = vocab_itos.index('<pad>')
     args.filter_sizes = [int(size) for size in args.filter_sizes.split(',')]
 
     classifier = TextCNN(args)
     if args.snapshot:
         print('\nLoading model from {}...\n'.format(args.snapshot))
-        classifier.load_state_dict(torch.load(args.snapshot))
+        state_dict = load_state_dict(args.snapshot)
+        # 裁剪了embedding的checkpoint不含embedding参数，使用本次加载的词向量
+        classifier.load_state_dict(state_dict, strict='embedding.weight' in state_dict)
+    classifier.to(device)
+    model = DistributedDataParallel(classifier) if dist.is_initialized() else classifier
 
+    best_acc = None
     try:
-        train(train_iter, val_iter, classifier, args)
+        if args.epochs > 0:
+            best_acc = train(train_iter, val_iter, model, args)
     except KeyboardInterrupt:
         print('Exit from training early')
+    if args.export_dir and args.rank == 0:
+        export(classifier, val_iter, args)
+    return best_acc
+
+
+def distributed_worker(rank, args, queue):
+    """
+    mp.spawn启动的训练进程：按nproc划分线程数，加入本机gloo进程组；非rank 0进程不输出日志
+    """
+    torch.set_num_threads(args.threads or max(1, (os.cpu_count() or 1) // args.nproc))
+    if args.nproc > 1:
+        os.environ['MASTER_ADDR'] = '127.0.0.1'
+        os.environ['MASTER_PORT'] = str(args.master_port)
+        dist.init_process_group('gloo', rank=rank, world_size=args.nproc)
+    if rank != 0:
+        sys.stdout = open(os.devnull, 'w')
+    try:
+        best_acc = run(args)
+        if rank == 0:
+            queue.put((best_acc, getattr(args, 'train_throughput', None)))
+    finally:
+        if dist.is_initialized():
+            dist.destroy_process_group()
+
+
+def launch(args):
+    """
+    用nproc个进程训练，返回rank 0的(最优准确率, 训练吞吐)；分词缓存和词向量缓存先在主进程建好，避免各进程同时构建
+    """
+    if args.token_cache:
+        token_cache.load(args.train_file, args.test_file, args.cache_dir)
+    if args.w2v_binary:
+        word_vectors.load(args.w2v_name, args.w2v_path, args.w2v_dtype)
+    queue = mp.get_context('spawn').SimpleQueue()
+    mp.spawn(distributed_worker, args=(args, queue), nprocs=args.nproc)
+    return queue.get()
+
+
+def scaling_report(args):
+    """
+    依次用每个进程数训练同样的epoch数，以第一个进程数为基准报告加速比和扩展效率（加速比 / 进程数倍数）。
+    每个进程的batch_size不变，进程数增加时全局batch随之增大
+    """
+    counts = [int(n) for n in args.scaling.split(',')]
+    rows = []
+    for nproc in counts:
+        args.nproc = nproc
+        print('\n==> Training with {} process(es)'.format(nproc))
+        best_acc, throughput = launch(args)
+        rows.append((nproc, throughput, best_acc))
+    base_nproc, base_throughput = rows[0][0], rows[0][1]
+    print('\n{:<8}{:>14}{:>10}{:>12}{:>10}'.format('nproc', 'samples/s', 'speedup', 'efficiency', 'acc'))
+    for nproc, throughput, best_acc in rows:
+        speedup = throughput / base_throughput
+        print('{:<8}{:>14.1f}{:>10.2f}{:>12.1%}{:>10.4f}'.format(nproc, throughput, speedup,
+                                                                 speedup / (nproc / base_nproc), best_acc or 0))
+
+
+def main():
+    args = build_parser().parse_args()
+    if args.scaling:
+        scaling_report(args)
+    elif args.nproc > 1:
+        launch(args)
+    else:
+        if args.threads:
+            torch.set_num_threads(args.threads)
+        run(args)
 
 
 if __name__ == '__main__':
@@ -24,33 +24,215 @@ def get_lam_beta(alpha, batch_size):
     return m.sample(sample_shape=torch.Size([batch_size]))
 
 
-def wordMixup(x0, x1, alpha=1.0):
-    x_size = x0.size()
+class LamSampler(object):
+    """
+    预先在目标设备上一次采样buffer_size个Beta(alpha, alpha)，每步按batch大小取出一段，用完或设备/类型变化时重新采样，
+    避免训练循环中每步构造Beta分布和在host上分配张量
+    """
+    def __init__(self, alpha=1.0, buffer_size=4096):
+        self.alpha = alpha
+        self.buffer_size = buffer_size
+        self.buffer = None
+        self.pos = 0
 
-    lam = get_lam_beta(alpha, x_size[0])
-    lam_re_x = lam.repeat([1, x_size[2]])
-    lam_re_x = torch.reshape(lam_re_x, [x_size[0],1,x_size[2]])
-    lam_re_x= lam_re_x.repeat([1, x_size[1], 1])
+    def refill(self, device=None, dtype=torch.float32, size=None):
+        alpha = torch.tensor([self.alpha], dtype=torch.float32, device=device)
+        m = Beta(alpha, alpha)
+        self.buffer = m.sample(sample_shape=torch.Size([size or self.buffer_size])).to(dtype)
+        self.pos = 0
+
+    def sample(self, batch_size, like=None):
+        """
+        --return: [batch_size, 1]的lam，与like在同一设备、同一类型
+        """
+        device = like.device if like is not None else torch.device('cpu')
+        dtype = like.dtype if like is not None else torch.float32
+        if self.buffer is None or self.buffer.device != device or self.buffer.dtype != dtype \
+                or self.pos + batch_size > self.buffer.size()[0]:
+            self.refill(device, dtype, max(self.buffer_size, batch_size))
+        lam = self.buffer[self.pos:self.pos + batch_size]
+        self.pos += batch_size
+        return lam
 
-    aug = lam_re_x * x0 + (1-lam_re_x) * x1
-    return aug, lam
 
+def sample_lam(alpha, batch_size, like, sampler=None):
+    if sampler is None:
+        return get_lam_beta(alpha, batch_size)
+    return sampler.sample(batch_size, like)
 
-def sentenceMixup(sen0, sen1, alpha=1.0):
-    sen_size = sen0.size()
-    lam = get_lam_beta(alpha, sen_size[0])
-    lam_re_sen = lam.repeat([1, sen_size[1]])
 
-    aug = lam_re_sen * sen0 + (1-lam_re_sen) * sen1
+def mix(x0, x1, lam):
+    """
+    lam * x0 + (1-lam) * x1，lam形状为[B, 1]，按x0的维数reshape成[B, 1, ...]后广播，不生成与x0同形的lam
+    """
+    lam = lam.to(device=x0.device, dtype=x0.dtype).view([-1] + [1] * (x0.dim() - 1))
+    return torch.lerp(x1, x0, lam)
+
+
+def length_mask(lengths, max_len):
+    """
+    --return: [B, max_len]的bool张量，真实token的位置为True
+    """
+    return torch.arange(max_len, device=lengths.device).unsqueeze(0) < lengths.unsqueeze(1)
+
+
+def mix_masked(x0, x1, lam, len0, len1):
+    """
+    按长度只在两句真实token的并集上混合[B, L, D]的词向量：两句都有token的位置按lam混合，
+    只有一句有token的位置直接取该句，PAD不会混入真实token
+    --return: 混合结果，以及混合后的长度max(len0, len1)
+    """
+    max_len = x0.size()[1]
+    mask0 = length_mask(len0, max_len).unsqueeze(2)
+    mask1 = length_mask(len1, max_len).unsqueeze(2)
+    lam = lam.to(device=x0.device, dtype=x0.dtype).view(-1, 1, 1)
+    weight = torch.where(mask1, torch.where(mask0, lam, torch.zeros_like(lam)), torch.ones_like(lam))
+    return torch.lerp(x1, x0, weight), torch.max(len0, len1)
+
+
+def wordMixup(x0, x1, alpha=1.0, sampler=None):
+    lam = sample_lam(alpha, x0.size()[0], x0, sampler)
+    aug = mix(x0, x1, lam)
+    return aug, lam
+
+
+def sentenceMixup(sen0, sen1, alpha=1.0, sampler=None):
+    lam = sample_lam(alpha, sen0.size()[0], sen0, sampler)
+    aug = mix(sen0, sen1, lam)
     return aug, lam
 
 
+def permMixup(x, alpha=1.0, index=None, sampler=None):
+    """
+    每个样本与同一batch的随机排列配对，混合结果替换原batch，不增加batch大小
+    --return: 混合后的x，lam[B, 1]，配对样本的下标index
+    """
+    if index is None:
+        index = torch.randperm(x.size()[0], device=x.device)
+    lam = sample_lam(alpha, x.size()[0], x, sampler)
+    aug = mix(x, x[index], lam)
+    return aug, lam, index
+
+
+def hiddenMixup(xs, alpha=1.0, rate_mixup=0.5, pairing='split', sampler=None, lengths=None):
+    """
+    对任意一层的输出做mixup，xs为该层的一个或多个并行输出（如TextCNN各卷积分支），共享同一组lam和配对：
+    split: batch前rate_mixup比例的样本与末尾样本混合，追加到batch后；perm: 与batch的随机排列原地混合。
+    给出lengths时xs为[B, L, D]的词向量，按mix_masked只在真实token上混合；
+    split时batch太小（如按token预算分桶的单句batch）取不到一个混合样本，原样返回xs，lam为None
+    --return: 混合后的xs，以及split时的lam，perm时的(lam, index)
+    """
+    batch_size = xs[0].size()[0]
+    if pairing == 'perm':
+        index = torch.randperm(batch_size, device=xs[0].device)
+        lam = sample_lam(alpha, batch_size, xs[0], sampler)
+        if lengths is not None:
+            return [mix_masked(x, x[index], lam, lengths, lengths[index])[0] for x in xs], (lam, index)
+        return [mix(x, x[index], lam) for x in xs], (lam, index)
+    batch_mix_index = int(batch_size * rate_mixup)
+    if batch_mix_index == 0:
+        return list(xs), None
+    lam = sample_lam(alpha, batch_mix_index, xs[0], sampler)
+    if lengths is not None:
+        x_mix = [mix_masked(x[:batch_mix_index], x[-batch_mix_index:], lam,
+                            lengths[:batch_mix_index], lengths[-batch_mix_index:])[0] for x in xs]
+    else:
+        x_mix = [mix(x[:batch_mix_index], x[-batch_mix_index:], lam) for x in xs]
+    return [torch.cat((x, item), 0) for x, item in zip(xs, x_mix)], lam
+
+
+def nll(log_prob, target):
+    return -log_prob.gather(1, target.unsqueeze(1)).squeeze(1)
+
+
 def loss_mixup(logits, target, batch_mix, lam):
-    lam = lam.squeeze(1)
-    loss = F.cross_entropy(logits[:-batch_mix], target)
+    """
+    logits前B个为原样本，后batch_mix个为混合样本；整体只做一次log_softmax，
+    混合样本的两个标签各gather一次后按lam加权
+    """
+    lam = lam.squeeze(1).to(logits)
+    log_prob = F.log_softmax(logits, dim=1)
+    loss = nll(log_prob[:-batch_mix], target).mean()
 
-    loss_x0 = F.cross_entropy(logits[-batch_mix:], target[:batch_mix], reduce=False)
-    loss_x1 = F.cross_entropy(logits[-batch_mix:], target[-batch_mix:], reduce=False)
+    log_prob_mix = log_prob[-batch_mix:]
+    loss_x0 = nll(log_prob_mix, target[:batch_mix])
+    loss_x1 = nll(log_prob_mix, target[-batch_mix:])
 
-    total_loss = loss + torch.mean(lam *loss_x0 + (1-lam) * loss_x1)
+    total_loss = loss + torch.mean(torch.lerp(loss_x1, loss_x0, lam))
     return total_loss
+
+
+def loss_mixup_perm(logits, target, index, lam):
+    """
+    permMixup的loss，只在混合后的batch上计算
+    """
+    lam = lam.squeeze(1).to(logits)
+    log_prob = F.log_softmax(logits, dim=1)
+    loss_x0 = nll(log_prob, target)
+    loss_x1 = nll(log_prob, target[index])
+    return torch.mean(torch.lerp(loss_x1, loss_x0, lam))
+
+
+def benchmark_mix(batch_size=64, seq_len=128, dim=300, repeat=50):
+    """
+    对比原先用repeat生成[B, L, D]的lam张量与广播实现的耗时和lam占用内存
+    """
+    import time
+
+    def word_mixup_repeat(x0, x1, lam):
+        x_size = x0.size()
+        lam_re_x = lam.repeat([1, x_size[2]])
+        lam_re_x = torch.reshape(lam_re_x, [x_size[0], 1, x_size[2]])
+        lam_re_x = lam_re_x.repeat([1, x_size[1], 1])
+        return lam_re_x * x0 + (1 - lam_re_x) * x1, lam_re_x
+
+    x0 = torch.randn(batch_size, seq_len, dim)
+    x1 = torch.randn(batch_size, seq_len, dim)
+    lam = get_lam_beta(1.0, batch_size)
+    ref, lam_re_x = word_mixup_repeat(x0, x1, lam)
+    assert torch.allclose(ref, mix(x0, x1, lam), atol=1e-6)
+    for name, fn in (('repeat', lambda: word_mixup_repeat(x0, x1, lam)), ('broadcast', lambda: mix(x0, x1, lam))):
+        start = time.time()
+        for _ in range(repeat):
+            fn()
+        print('{:<10}{:.3f} ms/iter'.format(name, (time.time() - start) / repeat * 1000))
+    print('lam memory: repeat {:.1f} KB, broadcast {:.3f} KB'.format(
+        lam_re_x.numel() * lam_re_x.element_size() / 1024, lam.numel() * lam.element_size() / 1024))
+
+
+def benchmark_loss(batch_size=64, class_num=2, rate_mixup=0.5, repeat=200):
+    """
+    对比三次F.cross_entropy的原实现与融合实现的数值和forward+backward耗时
+    """
+    import time
+
+    def loss_mixup_reference(logits, target, batch_mix, lam):
+        lam = lam.squeeze(1)
+        loss = F.cross_entropy(logits[:-batch_mix], target)
+        loss_x0 = F.cross_entropy(logits[-batch_mix:], target[:batch_mix], reduction='none')
+        loss_x1 = F.cross_entropy(logits[-batch_mix:], target[-batch_mix:], reduction='none')
+        return loss + torch.mean(lam * loss_x0 + (1 - lam) * loss_x1)
+
+    batch_mix = int(batch_size * rate_mixup)
+    logits = torch.randn(batch_size + batch_mix, class_num, requires_grad=True)
+    target = torch.randint(class_num, (batch_size,))
+    lam = get_lam_beta(1.0, batch_mix)
+    ref = loss_mixup_reference(logits, target, batch_mix, lam)
+    fused = loss_mixup(logits, target, batch_mix, lam)
+    print('loss: reference {:.6f}, fused {:.6f}'.format(ref.item(), fused.item()))
+    assert torch.allclose(ref, fused, atol=1e-5)
+    for name, fn in (('reference', loss_mixup_reference), ('fused', loss_mixup)):
+        start = time.time()
+        for _ in range(repeat):
+            logits.grad = None
+            fn(logits, target, batch_mix, lam).backward()
+        print('{:<10}{:.3f} ms/iter'.format(name, (time.time() - start) / repeat * 1000))
+
+
+if __name__ == '__main__':
+    for size in ((20, 32, 300), (64, 128, 300), (128, 512, 300)):
+        print('batch={} seq_len={} dim={}'.format(*size))
+        benchmark_mix(*size)
+    for batch_size, class_num in ((20, 2), (128, 2), (128, 100)):
+        print('batch={} class_num={}'.format(batch_size, class_num))
+        benchmark_loss(batch_size, class_num)
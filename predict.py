@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+@File    :   predict.py
+@Time    :   2020/8/20
+@Software:   PyCharm
+@Author  :   Li Chen
+@Desc    :   加载eval_aug.py保存的checkpoint，对文本批量打分；支持stdin/文件批处理和本地HTTP服务，服务模式下按最大等待时间做micro-batch
+"""
+
+import argparse
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import torch
+import torch.nn.functional as F
+from classifiers.textCNN import TextCNN
+from classifiers.pruned_embedding import PrunedEmbedding
+import dataset
+
+# torch<1.9没有inference_mode
+inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+
+
+def load_model(checkpoint_path):
+    """
+    --return: 模型，token到id的映射函数，pad的id，标签表
+    """
+    checkpoint = torch.load(checkpoint_path, map_location='cpu')
+    if 'vocab' not in checkpoint:
+        raise ValueError('{} has no vocabulary, re-save it with eval_aug.py'.format(checkpoint_path))
+    args = argparse.Namespace(**checkpoint['args'])
+    args.mixup, args.alpha, args.rate_mixup, args.mixup_pairing = None, 1.0, 0.5, 'split'
+    if checkpoint.get('embedding'):
+        store = PrunedEmbedding.load(os.path.join(os.path.dirname(checkpoint_path), checkpoint['embedding']))
+        args.vectors = store.weight()
+        args.vocabulary_size = len(store)
+        lookup, pad_id = store.lookup, store.pad_id
+    else:
+        args.vectors = checkpoint['state_dict']['embedding.weight']
+        stoi = {token: i for i, token in enumerate(checkpoint['vocab'])}
+        unk_id = stoi.get('<unk>', 0)
+        lookup, pad_id = lambda token: stoi.get(token, unk_id), stoi.get('<pad>', 1)
+    args.pad_id = pad_id
+    model = TextCNN(args)
+    model.load_state_dict(checkpoint['state_dict'], strict=not checkpoint.get('embedding'))
+    model.eval()
+    return model, lookup, pad_id, checkpoint['labels']
+
+
+class Predictor(object):
+    """
+    分词、转id、补齐后一次前向，返回每条文本的(标签, 概率)
+    """
+    def __init__(self, model, lookup, pad_id, labels):
+        self.model = model
+        self.lookup = lookup
+        self.pad_id = pad_id
+        # 训练时标签下标减了1（去掉<unk>），第i类对应labels[i+1]
+        self.labels = labels[1:]
+        self.min_len = max(model.args.filter_sizes)
+
+    def numericalize(self, texts):
+        ids = [[self.lookup(token.lower()) for token in dataset.tokenizer(text)] for text in texts]
+        lengths = [max(len(item), 1) for item in ids]
+        max_len = max(max(lengths), self.min_len)
+        batch = torch.full((len(ids), max_len), self.pad_id, dtype=torch.long)
+        for i, item in enumerate(ids):
+            batch[i, :len(item)] = torch.tensor(item, dtype=torch.long)
+        return batch, torch.tensor(lengths)
+
+    def predict(self, texts):
+        feature, lengths = self.numericalize(texts)
+        with inference_mode():
+            logits, _ = self.model(feature, lengths=lengths)
+            prob, pred = F.softmax(logits, dim=1).max(1)
+        return [(self.labels[i] if i < len(self.labels) else '<unk>', p)
+                for i, p in zip(pred.tolist(), prob.tolist())]
+
+
+class LatencyStats(object):
+    def __init__(self):
+        self.latencies = []
+        self.start = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, latency, count=1):
+        with self._lock:
+            self.latencies.extend([latency] * count)
+
+    def summary(self):
+        with self._lock:
+            latencies = sorted(self.latencies)
+        elapsed = time.time() - self.start
+        if not latencies:
+            return {'requests': 0, 'qps': 0.0, 'p50_ms': 0.0, 'p99_ms': 0.0}
+        return {
+            'requests': len(latencies),
+            'qps': len(latencies) / elapsed,
+            'p50_ms': latencies[int(0.50 * (len(latencies) - 1))] * 1000,
+            'p99_ms': latencies[int(0.99 * (len(latencies) - 1))] * 1000,
+        }
+
+
+class MicroBatcher(object):
+    """
+    收集并发到达的请求，凑够max_batch条或第一条请求等待超过max_latency秒后一起前向
+    """
+    def __init__(self, predictor, max_batch=64, max_latency=0.01):
+        self.predictor = predictor
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.stats = LatencyStats()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, text):
+        future = Future()
+        self._queue.put((text, future, time.time()))
+        return future
+
+    def _run(self):
+        while True:
+            items = [self._queue.get()]
+            deadline = items[0][2] + self.max_latency
+            while len(items) < self.max_batch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                results = self.predictor.predict([item[0] for item in items])
+            except Exception as e:
+                for _, future, _ in items:
+                    future.set_exception(e)
+                continue
+            now = time.time()
+            for (_, future, arrive), result in zip(items, results):
+                self.stats.add(now - arrive)
+                future.set_result(result)
+
+
+def make_handler(batcher):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _reply(self, code, result):
+            body = json.dumps(result, ensure_ascii=False).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._reply(200, batcher.stats.summary())
+            else:
+                self._reply(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self._reply(404, {'error': 'not found'})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+                texts = request['texts'] if 'texts' in request else [request['text']]
+            except (ValueError, KeyError) as e:
+                self._reply(400, {'error': 'bad request: {}'.format(e)})
+                return
+            futures = [batcher.submit(text) for text in texts]
+            results = [future.result() for future in futures]
+            self._reply(200, [{'label': label, 'prob': prob} for label, prob in results])
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def predict_lines(predictor, lines, batch_size, output):
+    stats = LatencyStats()
+    for start in range(0, len(lines), batch_size):
+        batch = lines[start:start + batch_size]
+        begin = time.time()
+        results = predictor.predict(batch)
+        stats.add(time.time() - begin, len(batch))
+        for text, (label, prob) in zip(batch, results):
+            output.write('{}\t{:.4f}\t{}\n'.format(label, prob, text))
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='text classifier inference')
+    parser.add_argument('--checkpoint', type=str, required=True, help='checkpoint saved by eval_aug.py')
+    parser.add_argument('--input', type=str, default='-', help='file with one text per line, - for stdin [default: -]')
+    parser.add_argument('--batch_size', type=int, default=64, help='batch size of offline prediction [default: 64]')
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads [default: torch default]')
+    parser.add_argument('--serve', action='store_true', help='start a local HTTP service instead of reading input')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='host of the HTTP service')
+    parser.add_argument('--port', type=int, default=8080, help='port of the HTTP service')
+    parser.add_argument('--max_batch', type=int, default=64, help='max micro-batch size of the service [default: 64]')
+    parser.add_argument('--max_latency', type=float, default=0.01,
+                        help='max seconds a request waits for its micro-batch [default: 0.01]')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    predictor = Predictor(*load_model(args.checkpoint))
+
+    if args.serve:
+        batcher = MicroBatcher(predictor, args.max_batch, args.max_latency)
+        server = ThreadingHTTPServer((args.host, args.port), make_handler(batcher))
+        server.daemon_threads = True
+        print('serving on http://{}:{}/predict'.format(args.host, args.port), file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+        stats = batcher.stats
+    else:
+        input_file = sys.stdin if args.input == '-' else open(args.input, 'r', encoding='utf-8')
+        lines = [line.strip() for line in input_file if line.strip()]
+        stats = predict_lines(predictor, lines, args.batch_size, sys.stdout)
+    summary = stats.summary()
+    print('requests: {requests}  QPS: {qps:.1f}  p50: {p50_ms:.2f}ms  p99: {p99_ms:.2f}ms'.format(**summary),
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
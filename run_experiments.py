@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+@File    :   run_experiments.py
+@Time    :   2020/8/25
+@Software:   PyCharm
+@Author  :   Li Chen
+@Desc    :   按网格（数据集 × 增强方法 × mixup模式 × 随机种子）并行运行eval_aug，词向量只加载一次，汇总准确率均值和标准差
+"""
+
+import argparse
+import itertools
+import json
+import os
+import statistics
+import time
+from contextlib import redirect_stdout
+import torch
+import torch.multiprocessing as mp
+import eval_aug
+import token_cache
+import word_vectors
+
+# 所有实验共用一份词向量，这些参数不能出现在网格中
+W2V_KEYS = ['w2v_name', 'w2v_path', 'w2v_binary', 'w2v_dtype']
+
+_w2v = None
+
+
+def load_grid(path, seeds=None):
+    """
+    网格文件为json：base为所有实验共用的eval_aug参数，grid为参数名到取值列表的映射，seeds为随机种子列表，例如
+    {"base": {"test_file": "data/ori_data/test.csv"},
+     "grid": {"train_file": ["data/ori_data/auto_100.csv", "data/aug_data/eda_auto_100.csv"], "mixup": [null, "word"]},
+     "seeds": [1, 2, 3]}
+    --return: base参数、网格中的参数名、所有实验（网格取值, 种子）
+    """
+    with open(path, encoding='utf-8') as f:
+        spec = json.load(f)
+    base, grid = spec.get('base', {}), spec.get('grid', {})
+    known = vars(eval_aug.build_parser().parse_args(['--train_file', '', '--test_file', '']))
+    for key in list(base) + list(grid):
+        if key not in known:
+            raise ValueError('unknown eval_aug argument in grid: {}'.format(key))
+    for key in W2V_KEYS:
+        if key in grid:
+            raise ValueError('{} is shared by all trials and cannot be part of the grid'.format(key))
+    # 进程池中的实验各自单进程训练，数据并行只能通过eval_aug.py --nproc启动
+    for key in ('nproc', 'scaling'):
+        if key in base or key in grid:
+            raise ValueError('{} is not supported in a grid, run eval_aug.py directly'.format(key))
+    keys = list(grid)
+    seeds = seeds or spec.get('seeds') or [None]
+    trials = [(values, seed) for values in itertools.product(*[grid[key] for key in keys]) for seed in seeds]
+    return base, keys, trials
+
+
+def trial_args(base, keys, values, seed):
+    config = dict(base, **dict(zip(keys, values)))
+    args = eval_aug.build_parser().parse_args(['--train_file', config['train_file'],
+                                               '--test_file', config['test_file']])
+    for key, value in config.items():
+        setattr(args, key, value)
+    args.seed = seed
+    # 进程池的worker是daemon进程，不能再启动DataLoader的worker
+    args.num_workers = 0
+    return args
+
+
+def load_shared_vectors(args):
+    """
+    二进制缓存的词向量只传路径，各进程memmap打开同一组文件，物理页由系统共享；
+    文本格式的词向量在主进程加载一次，矩阵放入共享内存后传给worker
+    """
+    if args.w2v_binary:
+        prefix = os.path.join(args.w2v_path, args.w2v_name)
+        word_vectors.load(args.w2v_name, args.w2v_path, args.w2v_dtype)
+        return 'binary', (prefix, args.w2v_dtype)
+    vectors = eval_aug.load_word_vectors(args.w2v_name, args.w2v_path)
+    vectors.vectors.share_memory_()
+    return 'vectors', vectors
+
+
+def init_worker(w2v, threads):
+    global _w2v
+    torch.set_num_threads(threads)
+    kind, value = w2v
+    _w2v = word_vectors.MemmapVectors(*value) if kind == 'binary' else value
+
+
+def run_trial(task):
+    index, args, log_path = task
+    start = time.time()
+    try:
+        with open(log_path, 'w', encoding='utf-8') as f, redirect_stdout(f):
+            acc = eval_aug.run(args, _w2v)
+        error = None
+    except Exception as e:
+        acc, error = None, repr(e)
+    return index, acc, time.time() - start, error
+
+
+def summarize(keys, trials, results):
+    """
+    --return: 按网格取值分组，每组为(取值, 准确率列表, 平均耗时)
+    """
+    groups = {}
+    for (values, _), (acc, elapsed, error) in zip(trials, results):
+        accs, times = groups.setdefault(values, ([], []))
+        if acc is not None:
+            accs.append(float(acc))
+        times.append(elapsed)
+    return [(values, accs, sum(times) / len(times)) for values, (accs, times) in groups.items()]
+
+
+def format_table(keys, rows):
+    header = '| ' + ' | '.join(keys + ['mean', 'std', 'n', 'time(s)']) + ' |'
+    lines = [header, '|' + '|'.join([':---'] * (len(keys) + 4)) + '|']
+    for values, accs, elapsed in rows:
+        mean = 100 * statistics.mean(accs) if accs else float('nan')
+        std = 100 * statistics.stdev(accs) if len(accs) > 1 else 0.0
+        lines.append('| ' + ' | '.join([str(value) for value in values] +
+                                       ['{:.1f}'.format(mean), '{:.1f}'.format(std), str(len(accs)),
+                                        '{:.1f}'.format(elapsed)]) + ' |')
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='run eval_aug over a grid of settings in parallel')
+    parser.add_argument('--grid', type=str, required=True, help='json file of base arguments, grid and seeds')
+    parser.add_argument('--seeds', type=str, default=None, help='comma-separated seeds, overrides the grid file')
+    parser.add_argument('--jobs', type=int, default=None, help='trials run in parallel [default: all cores]')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='torch threads per trial [default: cores divided by jobs]')
+    parser.add_argument('--out_dir', type=str, default='experiments/', help='where to keep logs and results')
+    args = parser.parse_args()
+
+    seeds = [int(seed) for seed in args.seeds.split(',')] if args.seeds else None
+    base, keys, trials = load_grid(args.grid, seeds)
+    trial_list = [trial_args(base, keys, values, seed) for values, seed in trials]
+    cores = os.cpu_count() or 1
+    jobs = max(1, min(args.jobs or cores, len(trial_list)))
+    # 各实验的线程数之和不超过核数，避免互相抢占
+    threads = args.threads or max(1, cores // jobs)
+    os.makedirs(os.path.join(args.out_dir, 'logs'), exist_ok=True)
+
+    print('Loading word vectors...')
+    w2v = load_shared_vectors(trial_list[0])
+    # 分词缓存在主进程中依次建好，worker只读取
+    for trial in trial_list:
+        if trial.token_cache:
+            token_cache.load(trial.train_file, trial.test_file, trial.cache_dir)
+
+    print('Running {} trials, {} in parallel with {} threads each'.format(len(trial_list), jobs, threads))
+    tasks = [(i, trial, os.path.join(args.out_dir, 'logs', 'trial_{}.log'.format(i)))
+             for i, trial in enumerate(trial_list)]
+    results = [None] * len(tasks)
+    with mp.Pool(jobs, initializer=init_worker, initargs=(w2v, threads)) as pool, \
+            open(os.path.join(args.out_dir, 'results.jsonl'), 'w', encoding='utf-8') as f:
+        for done, (i, acc, elapsed, error) in enumerate(pool.imap_unordered(run_trial, tasks), 1):
+            results[i] = (acc, elapsed, error)
+            values, seed = trials[i]
+            config = dict(zip(keys, values), seed=seed)
+            print('[{}/{}] {} acc: {}  {:.1f}s{}'.format(done, len(tasks), config, acc, elapsed,
+                                                        '  error: ' + error if error else ''))
+            f.write(json.dumps(dict(config, acc=acc, time=elapsed, error=error), ensure_ascii=False) + '\n')
+            f.flush()
+
+    table = format_table(keys, summarize(keys, trials, results))
+    with open(os.path.join(args.out_dir, 'summary.md'), 'w', encoding='utf-8') as f:
+        f.write(table + '\n')
+    print('\n' + table)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+@File    :   token_cache.py
+@Time    :   2020/8/24
+@Software:   PyCharm
+@Author  :   Li Chen
+@Desc    :   训练/测试集分词、建词表的结果缓存为扁平int32 id数组+偏移量，memmap加载，重复实验不再分词
+"""
+
+import csv
+import hashlib
+import json
+import os
+import random
+import shutil
+from collections import Counter
+import numpy as np
+import torch
+import torch.utils.data.distributed
+import dataset
+
+# 分词方式或缓存格式变化时加一，旧缓存自动失效
+CACHE_VERSION = 1
+SPECIALS = ['<unk>', '<pad>']
+
+
+def file_hash(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def cache_key(train_path, val_path, lower=True, min_freq=1):
+    """
+    --return: 由两个文件内容、分词器版本和词表设置决定的缓存目录名
+    """
+    settings = {'train': file_hash(train_path), 'val': file_hash(val_path), 'version': CACHE_VERSION,
+                'tokenizer': dataset.TOKENIZER_VERSION, 'lower': lower, 'min_freq': min_freq, 'specials': SPECIALS}
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def read_csv(path, lower=True):
+    """
+    与TabularDataset(format='csv', skip_header=True)相同：每行为label,text
+    """
+    labels, texts = [], []
+    with open(path, encoding='utf-8') as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        for row in reader:
+            if len(row) < 2:
+                continue
+            tokens = dataset.tokenizer(row[1])
+            labels.append(row[0])
+            texts.append([token.lower() for token in tokens] if lower else tokens)
+    return labels, texts
+
+
+def build_itos(counter, specials, min_freq=1):
+    # 与torchtext Vocab一致：specials在前，其余按词频降序、同频按字典序
+    words = sorted((word for word in counter if word not in specials and counter[word] >= min_freq),
+                   key=lambda word: (-counter[word], word))
+    return list(specials) + words
+
+
+def build(train_path, val_path, cache_dir, lower=True, min_freq=1):
+    splits = {'train': read_csv(train_path, lower), 'val': read_csv(val_path, lower)}
+    tokens, labels = Counter(), Counter()
+    for split_labels, texts in splits.values():
+        labels.update(split_labels)
+        for text in texts:
+            tokens.update(text)
+    itos = build_itos(tokens, SPECIALS, min_freq)
+    label_itos = build_itos(labels, ['<unk>'])
+    stoi = {token: i for i, token in enumerate(itos)}
+    label_stoi = {label: i for i, label in enumerate(label_itos)}
+
+    # 先写到临时目录再改名，中断的构建不会留下半个缓存
+    tmp_dir = cache_dir + '.tmp{}'.format(os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+    for split, (split_labels, texts) in splits.items():
+        offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+        np.cumsum([len(text) for text in texts], out=offsets[1:])
+        ids = np.fromiter((stoi.get(token, 0) for text in texts for token in text), dtype=np.int32,
+                          count=int(offsets[-1]))
+        np.save(os.path.join(tmp_dir, split + '.ids.npy'), ids)
+        np.save(os.path.join(tmp_dir, split + '.offsets.npy'), offsets)
+        np.save(os.path.join(tmp_dir, split + '.labels.npy'),
+                np.array([label_stoi[label] for label in split_labels], dtype=np.int64))
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump({'itos': itos, 'label_itos': label_itos, 'train_file': train_path, 'val_file': val_path},
+                  f, ensure_ascii=False)
+    if os.path.isdir(cache_dir):
+        # 其他进程已经建好同一个缓存
+        shutil.rmtree(tmp_dir)
+    else:
+        os.rename(tmp_dir, cache_dir)
+
+
+class TokenDataset(torch.utils.data.Dataset):
+    """
+    ragged存储：第i条样本的id为ids[offsets[i]:offsets[i+1]]；ids和offsets在每个进程第一次访问时才memmap打开，
+    DataLoader的worker进程（包括spawn方式启动的）只拿到路径，不会拷贝数组
+    """
+    def __init__(self, cache_dir, split):
+        self.path = os.path.join(cache_dir, split)
+        self.labels = np.load(self.path + '.labels.npy')
+        self._ids, self._offsets = None, None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_ids'], state['_offsets'] = None, None
+        return state
+
+    @property
+    def ids(self):
+        if self._ids is None:
+            self._ids = np.load(self.path + '.ids.npy', mmap_mode='r')
+        return self._ids
+
+    @property
+    def offsets(self):
+        if self._offsets is None:
+            self._offsets = np.load(self.path + '.offsets.npy', mmap_mode='r')
+        return self._offsets
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, i):
+        return self.ids[self.offsets[i]:self.offsets[i + 1]], self.labels[i]
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+
+def load(train_path, val_path, cache_root='data/cache/', lower=True, min_freq=1):
+    """
+    --return: 词表、标签表、训练集和测试集TokenDataset；缓存不存在时先分词建一次
+    """
+    cache_dir = os.path.join(cache_root, cache_key(train_path, val_path, lower, min_freq))
+    if not os.path.isdir(cache_dir):
+        print('Tokenizing {} and {} into {}...'.format(train_path, val_path, cache_dir))
+        os.makedirs(cache_root, exist_ok=True)
+        build(train_path, val_path, cache_dir, lower, min_freq)
+    with open(os.path.join(cache_dir, 'meta.json'), encoding='utf-8') as f:
+        meta = json.load(f)
+    return meta['itos'], meta['label_itos'], TokenDataset(cache_dir, 'train'), TokenDataset(cache_dir, 'val')
+
+
+class Batch(object):
+    """
+    与torchtext Batch字段一致：text为([seq_len, batch]的id, 长度)，label为带<unk>偏移的标签id
+    """
+    def __init__(self, text, label):
+        self.text = text
+        self.label = label
+        self.batch_size = label.size(0)
+
+    def pin_memory(self):
+        # DataLoader(pin_memory=True)对自定义batch类型调用此方法
+        return Batch((self.text[0].pin_memory(), self.text[1].pin_memory()), self.label.pin_memory())
+
+    def to(self, device, non_blocking=False):
+        return Batch((self.text[0].to(device, non_blocking=non_blocking),
+                      self.text[1].to(device, non_blocking=non_blocking)),
+                     self.label.to(device, non_blocking=non_blocking))
+
+
+class Collate(object):
+    def __init__(self, pad_id):
+        self.pad_id = pad_id
+
+    def __call__(self, examples):
+        """
+        在worker进程中执行：拼接一个batch的id后按长度mask一次写入[seq_len, batch]的padding矩阵
+        """
+        lengths = torch.tensor([len(ids) for ids, _ in examples], dtype=torch.long)
+        flat = torch.from_numpy(np.concatenate([ids for ids, _ in examples]).astype(np.int64))
+        text = torch.full((int(lengths.max()), len(examples)), self.pad_id, dtype=torch.long)
+        mask = torch.arange(text.size(0)).unsqueeze(0) < lengths.unsqueeze(1)
+        text.t()[mask] = flat
+        label = torch.tensor([label for _, label in examples], dtype=torch.long)
+        return Batch((text, lengths), label)
+
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    """
+    与BucketIterator相同的分桶：每100个batch_size的样本为一个池，池内按长度排序后切batch，batch顺序再打乱；
+    max_tokens不为空时按padding后的token数（样本数 * batch内最长样本长度）切batch。长度直接来自offsets，不读ids。
+    num_replicas>1时各进程用相同的seed+epoch打乱，丢掉不能整除的尾部batch后按rank轮流取，保证各进程的step数相同
+    """
+    def __init__(self, lengths, batch_size, max_tokens=None, shuffle=True, pool_batches=100,
+                 num_replicas=1, rank=0, seed=0):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.pool_size = batch_size * pool_batches
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self, indices):
+        batch, max_len = [], 0
+        for i in indices:
+            new_max = max(max_len, int(self.lengths[i]))
+            full = (len(batch) + 1) * new_max > self.max_tokens if self.max_tokens else len(batch) == self.batch_size
+            if batch and full:
+                yield batch
+                batch, new_max = [], int(self.lengths[i])
+            batch.append(i)
+            max_len = new_max
+        if batch:
+            yield batch
+
+    def __iter__(self):
+        rng = random.Random(self.seed + self.epoch) if self.num_replicas > 1 else random
+        indices = list(range(len(self.lengths)))
+        if self.shuffle:
+            rng.shuffle(indices)
+        batches = []
+        for start in range(0, len(indices), self.pool_size):
+            pool = sorted(indices[start:start + self.pool_size], key=lambda i: self.lengths[i])
+            batches.extend(self.batches(pool))
+        if self.shuffle:
+            rng.shuffle(batches)
+        if self.num_replicas > 1:
+            batches = batches[:len(batches) // self.num_replicas * self.num_replicas][self.rank::self.num_replicas]
+        return iter(batches)
+
+
+class DeviceLoader(object):
+    """
+    把pinned memory中的batch异步拷到GPU，其余属性（dataset等）转给内部的DataLoader
+    """
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        for batch in self.loader:
+            yield batch.to(self.device, non_blocking=True)
+
+
+def make_loader(token_dataset, pad_id, batch_size, shuffle=False, bucket=False, max_tokens=None,
+                num_workers=0, prefetch_factor=2, device=None, num_replicas=1, rank=0):
+    """
+    分词缓存上的DataLoader：num_workers>0时由worker进程读取memmap并padding，每个worker预取prefetch_factor个batch，
+    worker在epoch之间保留；device为GPU时batch放在pinned memory中并异步拷贝；
+    num_replicas>1时每个进程只取训练集的一份（DistributedSampler或分片的BucketBatchSampler），每个epoch前调用set_epoch
+    """
+    kwargs = {'collate_fn': Collate(pad_id), 'num_workers': num_workers}
+    if num_workers > 0:
+        kwargs.update(prefetch_factor=prefetch_factor, persistent_workers=True)
+    pin = device is not None and device.type == 'cuda'
+    if bucket:
+        sampler = BucketBatchSampler(token_dataset.lengths(), batch_size, max_tokens, shuffle,
+                                     num_replicas=num_replicas, rank=rank)
+        loader = torch.utils.data.DataLoader(token_dataset, batch_sampler=sampler, pin_memory=pin, **kwargs)
+    elif num_replicas > 1:
+        sampler = torch.utils.data.distributed.DistributedSampler(token_dataset, num_replicas, rank, shuffle=shuffle)
+        loader = torch.utils.data.DataLoader(token_dataset, batch_size=batch_size, sampler=sampler,
+                                             pin_memory=pin, **kwargs)
+    else:
+        loader = torch.utils.data.DataLoader(token_dataset, batch_size=batch_size, shuffle=shuffle,
+                                             pin_memory=pin, **kwargs)
+    return DeviceLoader(loader, device) if pin else loader
+
+
+def set_epoch(loader, epoch):
+    """
+    分布式训练时让各进程在每个epoch用相同的方式重新打乱；torchtext的Iterator或单进程的DataLoader不做任何事
+    """
+    for sampler in (getattr(loader, 'sampler', None), getattr(loader, 'batch_sampler', None)):
+        if hasattr(sampler, 'set_epoch'):
+            sampler.set_epoch(epoch)
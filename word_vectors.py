@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+@File    :   word_vectors.py
+@Time    :   2020/8/20
+@Software:   PyCharm
+@Author  :   Li Chen
+@Desc    :   把文本格式的预训练词向量一次性转换为.npy矩阵和按字节序排序的词索引，加载时memmap，只读取当前词表用到的行
+"""
+
+import argparse
+import bisect
+import os
+import numpy as np
+import torch
+from torchtext.vocab import Vectors
+
+
+def cache_paths(prefix, dtype='float32'):
+    """
+    --return: 向量矩阵、词的utf-8拼接、每个词的起始偏移 三个文件；向量矩阵的文件名包含dtype，不同精度的缓存互不覆盖
+    """
+    return prefix + '.vectors.{}.npy'.format(dtype), prefix + '.words.bin', prefix + '.offsets.npy'
+
+
+def convert(txt_path, prefix, dtype='float32'):
+    """
+    两遍扫描文本文件：第一遍只读词并排序，第二遍把向量写入按排序位置预分配的memmap，内存中不保留整个矩阵
+    """
+    words, dim = [], None
+    with open(txt_path, 'rb') as f:
+        for line in f:
+            items = line.rstrip().split(b' ')
+            if len(items) == 2:
+                # sgns等格式第一行为"词数 维度"
+                continue
+            if dim is None:
+                dim = len(items) - 1
+            if len(items) - 1 != dim:
+                continue
+            words.append(items[0])
+    order = sorted(range(len(words)), key=lambda i: words[i])
+    rank, sorted_words = {}, []
+    for i in order:
+        # 重复的词只保留第一次出现
+        if not sorted_words or words[i] != sorted_words[-1]:
+            rank[i] = len(sorted_words)
+            sorted_words.append(words[i])
+
+    vectors_path, words_path, offsets_path = cache_paths(prefix, dtype)
+    matrix = np.lib.format.open_memmap(vectors_path, mode='w+', dtype=dtype, shape=(len(sorted_words), dim))
+    with open(txt_path, 'rb') as f:
+        i = 0
+        for line in f:
+            items = line.rstrip().split(b' ')
+            if len(items) - 1 != dim:
+                continue
+            if i in rank:
+                matrix[rank[i]] = [float(x) for x in items[1:]]
+            i += 1
+    matrix.flush()
+    del matrix
+    offsets = np.zeros(len(sorted_words) + 1, dtype=np.int64)
+    with open(words_path, 'wb') as f:
+        for j, word in enumerate(sorted_words):
+            f.write(word)
+            offsets[j + 1] = offsets[j] + len(word)
+    np.save(offsets_path, offsets)
+    return len(sorted_words), dim
+
+
+class SortedWords(object):
+    """
+    memmap的有序词表，按utf-8字节序二分查找，不把全部词载入Python字典
+    """
+    def __init__(self, words_path, offsets_path):
+        self.blob = np.memmap(words_path, dtype=np.uint8, mode='r') if os.path.getsize(words_path) else b''
+        self.offsets = np.load(offsets_path, mmap_mode='r')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return bytes(self.blob[int(self.offsets[i]):int(self.offsets[i + 1])])
+
+    def index(self, word):
+        key = word.encode('utf-8')
+        i = bisect.bisect_left(self, key)
+        if i < len(self) and self[i] == key:
+            return i
+        return None
+
+
+class MemmapVectors(Vectors):
+    """
+    与torchtext Vectors接口兼容（build_vocab只用到dim和__getitem__），向量矩阵memmap加载，只读取查到的行
+    """
+    def __init__(self, prefix, dtype='float32', unk_init=None):
+        vectors_path, words_path, offsets_path = cache_paths(prefix, dtype)
+        self.unk_init = torch.Tensor.zero_ if unk_init is None else unk_init
+        self.words = SortedWords(words_path, offsets_path)
+        self.matrix = np.load(vectors_path, mmap_mode='r')
+        if self.matrix.dtype != np.dtype(dtype):
+            raise ValueError('{} is {}, not {}'.format(vectors_path, self.matrix.dtype, dtype))
+        self.dim = self.matrix.shape[1]
+
+    def __len__(self):
+        return len(self.words)
+
+    def __getitem__(self, token):
+        i = self.words.index(token)
+        if i is None:
+            return self.unk_init(torch.Tensor(self.dim))
+        return torch.from_numpy(np.array(self.matrix[i], dtype=np.float32))
+
+
+def load(w2v_name, w2v_path, dtype='float32'):
+    """
+    有缓存时直接memmap加载，否则先从w2v_path/w2v_name文本文件转换一次
+    """
+    prefix = os.path.join(w2v_path, w2v_name)
+    if not all(os.path.isfile(path) for path in cache_paths(prefix, dtype)):
+        print('Converting {} to {} binary cache...'.format(prefix, dtype))
+        convert(prefix, prefix, dtype)
+    return MemmapVectors(prefix, dtype)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='convert text word vectors to a memory-mapped binary cache')
+    parser.add_argument('--input', type=str, required=True, help='word vectors in text format')
+    parser.add_argument('--output', type=str, default=None, help='prefix of cache files [default: same as input]')
+    parser.add_argument('--dtype', type=str, default='float32', help='float32 or float16 [default: float32]')
+    args = parser.parse_args()
+    size, dim = convert(args.input, args.output or args.input, args.dtype)
+    print('converted {} words of dim {}'.format(size, dim))